@@ -1,13 +1,91 @@
 '''
 Run this script to ensure that your version of OpenCv is working with ffmpeg
 enabled. It should produce a video called 'test.m4v' that is simply a black
-screen turning white.
+screen turning white.  It then checks the ffmpeg writer backend used by
+the overlay scripts, producing the same video as 'test.mp4', and again at
+an odd size (padded to an even one) as 'test_odd.mp4'.  Last, it streams
+the video as MPEG-TS ('test.ts') from stand-in glasses to the live view's
+decoder, checking that frames come out matched to when they arrived.
 '''
 import cv2
 import numpy as np
+import os
+import threading
+from tobii_live_view import FrameArrivals, feed_video
+from tobii_mock_glasses import MockGlasses
+from tobii_record import GlassesClient, KeepAlive
+from tobii_video import FFmpegDecoder, FFmpegWriter
 
 OPENCV3 = (cv2.__version__.split('.')[0] == '3')
 
+
+def check_ffmpeg_writer(path, size):
+    out = FFmpegWriter(path, 30, size)
+    img = np.ones((size[1], size[0], 3), dtype=np.uint8)
+    for i in range(255):
+        out.write(img * i)
+    out.release()
+    vid = cv2.VideoCapture(path)
+    frames = 0
+    while True:
+        ret, frame = vid.read()
+        if not ret:
+            break
+        frames += 1
+        shape = frame.shape
+    if frames != 255:
+        raise Exception('ffmpeg writer wrote %i of 255 frames to %s' %
+                        (frames, path))
+    # odd sizes are padded to the next even one
+    even = (size[1] + size[1] % 2, size[0] + size[0] % 2, 3)
+    if shape != even:
+        raise Exception('ffmpeg writer wrote %s frames for %ix%i' %
+                        (shape, size[0], size[1]))
+
+
+def check_ffmpeg_decoder(path, size, frames=60, timeout=20):
+    glasses = MockGlasses(video=path,
+                          video_bitrate=8 * os.path.getsize(path) / 8.5)
+    glasses.start()
+    keepalive = KeepAlive()
+    client = GlassesClient(glasses.host, glasses.http_port,
+                           glasses.live_port)
+    data_socket, video_socket = client.live_sockets(keepalive)
+    keepalive.start()
+    decoder = FFmpegDecoder(size, timestamps=True)
+    arrivals = FrameArrivals()
+    running = threading.Event()
+    running.set()
+    feeder = threading.Thread(target=feed_video,
+                              args=[video_socket, decoder, arrivals, running])
+    feeder.start()
+
+    def stop():
+        running.clear()
+        feeder.join()
+        decoder.close()
+    # ends the stream, should too few frames come out
+    timer = threading.Timer(timeout, stop)
+    timer.start()
+    arrived = []
+    while len(arrived) < frames:
+        frame = decoder.read()
+        if frame is None:
+            break
+        arrived.append(arrivals.pop(decoder.pts))
+    timer.cancel()
+    stop()
+    keepalive.stop()
+    client.close()
+    glasses.stop()
+    if len(arrived) < frames:
+        raise Exception('ffmpeg decoder gave %i of %i frames from %s' %
+                        (len(arrived), frames, path))
+    if None in arrived:
+        raise Exception('%i of %i decoded frames not matched to their '
+                        'arrival' % (arrived.count(None), frames))
+
+
 def main():
     if OPENCV3:
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
@@ -21,6 +99,13 @@ def main():
     img = np.ones((200, 200, 3), dtype=np.uint8)
     for i in range(255):
         out.write(img * i)
+    out.release()
+
+    check_ffmpeg_writer('test.mp4', (200, 200))
+    check_ffmpeg_writer('test_odd.mp4', (201, 151))
+    check_ffmpeg_writer('test.ts', (200, 200))
+    check_ffmpeg_decoder('test.ts', (200, 200))
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -5,13 +5,148 @@
 '''
 import argparse
 import cv2
-import pandas as pd
+import numpy as np
 import os
+import Queue
+import threading
+import traceback
+from tobii_data_process import load_data, align_frames, frame_samples, \
+    GAZE_POS_COLUMNS
+from tobii_video import open_writer, draw_trail, WRITERS
 
 OPENCV3 = (cv2.__version__.split('.')[0] == '3')
 
-def process(gaze_file, infile, outfile, verbose=True):
-    gaze = pd.read_csv(gaze_file)
+QUEUE_SIZE = 8
+
+
+def show_progress(f, tot_frames):
+    prog_ratio = min((f + 1.) / tot_frames, 1)
+    print ('[' + int(prog_ratio * 50) * '=' + int((1 - prog_ratio) * 50) * '-' + ']'
+           ' %.1f %% Complete\r' % (prog_ratio * 100)),
+
+
+def decode_worker(vid, free, decoded, errors):
+    """
+    Reads frames into buffers taken from the `free` queue and puts them on
+    the `decoded` queue.  None marks the end, and a failed read stops
+    decoding and is appended to `errors`.
+    """
+    try:
+        while vid.isOpened():
+            ret, frame = vid.read(free.get())
+            if not ret:
+                break
+            decoded.put(frame)
+    except Exception:
+        errors.append(traceback.format_exc())
+    finally:
+        decoded.put(None)
+
+
+def encode_worker(out, encode, errors):
+    """
+    Writes each list of frames from the `encode` queue, then returns their
+    buffers to the free queues they came from.  None marks the end.  After a
+    failed write (appended to `errors`) buffers are still returned, so the
+    other stages don't block.
+    """
+    for frames, buffers in iter(encode.get, None):
+        if not errors:
+            try:
+                for frame in frames:
+                    out.write(frame)
+            except Exception:
+                errors.append(traceback.format_exc())
+        for buf, free in buffers:
+            free.put(buf)
+
+
+def gaze_frames(frame, samples, points, valid, trail, new_buffer):
+    """
+    Frames to write for one video frame, given the gaze samples shown on it
+    (-1 padded) and each sample's point and validity.  With trail, the frame
+    is written once with its samples drawn as a trail; otherwise once per
+    sample, with that sample's point drawn.  Gaze is drawn on a copy in a
+    buffer from new_buffer() (allocated if that gives None), and those
+    buffers are returned along with the frames.
+    """
+    if trail:
+        groups = [[i for i in samples if i >= 0 and valid[i]]]
+    else:
+        groups = [[i] if i >= 0 and valid[i] else [] for i in samples]
+    frames = []
+    drawn = []
+    for group in groups:
+        if not group:
+            frames.append(frame)
+            continue
+        buf = new_buffer()
+        if buf is None or buf.shape != frame.shape:
+            buf = np.empty_like(frame)
+        np.copyto(buf, frame)
+        draw_trail(buf, points[group])
+        frames.append(buf)
+        drawn.append(buf)
+    return frames, drawn
+
+
+def pipeline(vid, out, shown, points, valid, trail, tot_frames,
+             verbose=True):
+    """
+    Adds gaze to a video with decoding, drawing and encoding overlapped: a
+    decoder thread and an encoder thread are connected to the drawing loop
+    by bounded queues.  Decoded frames and frames with gaze drawn on them
+    use buffers that are recycled once the encoder has written them, and a
+    frame without valid gaze is written as is rather than copied.
+    """
+    decode_free = Queue.Queue()
+    draw_free = Queue.Queue()
+    # None lets the first frames allocate the buffers later ones reuse
+    for k in range(2 * QUEUE_SIZE + 2):
+        decode_free.put(None)
+        draw_free.put(None)
+    decoded = Queue.Queue(maxsize=QUEUE_SIZE)
+    encode = Queue.Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    threads = [threading.Thread(target=decode_worker,
+                                args=[vid, decode_free, decoded, errors]),
+               threading.Thread(target=encode_worker,
+                                args=[out, encode, errors])]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    no_gaze = -np.ones(shown.shape[1], int)
+    f = 0
+    while True:
+        frame = decoded.get()
+        if frame is None:
+            break
+        if verbose:
+            show_progress(f, tot_frames)
+        # the frame count is only an estimate, so show no gaze past its end
+        frames, drawn = gaze_frames(
+            frame, shown[f] if f < len(shown) else no_gaze, points, valid,
+            trail, draw_free.get)
+        buffers = [(frame, decode_free)] + [(buf, draw_free) for buf in drawn]
+        encode.put((frames, buffers))
+        f += 1
+    encode.put(None)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception('Adding gaze failed:\n' + errors[0])
+
+
+def process(gaze_file, infile, outfile, pipelined=True, writer='opencv',
+            preset='veryfast', crf=23, verbose=True):
+    """
+    Draws gaze on a scene camera video.  The opencv writer doubles the
+    framerate and writes each frame twice, once with each gaze sample drawn,
+    to keep playback speed; other writers (see tobii_video) keep the native
+    framerate and draw each frame's gaze samples as a trail.
+    """
+    gaze = load_data(gaze_file, columns=GAZE_POS_COLUMNS)
     # only start tracking eyes once video starts
     gaze = gaze[~gaze.vts_time.isnull()]
 
@@ -20,66 +155,54 @@ def process(gaze_file, infile, outfile, verbose=True):
 
     size = (1920, 1080)
     if OPENCV3:
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
         fps = vid.get(cv2.CAP_PROP_FPS)
         tot_frames = vid.get(cv2.CAP_PROP_FRAME_COUNT)
     else:
-        fourcc = cv2.cv.CV_FOURCC(*'mp4v')
         fps = vid.get(cv2.cv.CV_CAP_PROP_FPS)
         tot_frames = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
-    out = cv2.VideoWriter()
-    out.open(outfile + '.m4v', fourcc,
-             fps * 2, size, True)
-    # note doubled framerate b/c eye tracking is at double the sampling rate
-    # of video
-
-    i = 0
-    gaze_val = gaze['gaze_pos_val'].values
-    gaze_x = gaze['gaze_pos_x'].values
-    gaze_y = gaze['gaze_pos_y'].values
+    trail = writer != 'opencv'
+    if trail:
+        out = open_writer(outfile, fps, size, writer, preset=preset, crf=crf)
+    else:
+        # note doubled framerate b/c eye tracking is at double the sampling
+        # rate of video
+        out = open_writer(outfile, fps * 2, size, writer)
+
+    valid = gaze['gaze_pos_val'].values == 0
+    points = np.column_stack((1920 * gaze['gaze_pos_x'].values,
+                              1080 * gaze['gaze_pos_y'].values))
+    points[~valid] = 0
+    points = points.astype(int)
     vts = gaze['vts_time'].values / 1000.
 
+    # gaze samples to show on each frame: 2 per original frame to match the
+    # doubled framerate, or all of them for a trail
+    frame_times = np.arange(int(tot_frames)) * 1000. / fps
+    bounds = align_frames(vts, frame_times)
+    shown = frame_samples(bounds, np.diff(bounds).max()
+                          if trail and len(frame_times) else 2)
+
     if verbose:
         print "Adding gaze..."
-    while(vid.isOpened()):
-        if OPENCV3:
-            frame_num = vid.get(cv2.CAP_PROP_POS_FRAMES) + 1
-            vid_time = vid.get(cv2.CAP_PROP_POS_MSEC)
-        else:
-            frame_num = vid.get(cv2.cv.CV_CAP_PROP_POS_FRAMES) + 1
-            vid_time = vid.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-        prog_ratio = (frame_num * 1.0 / tot_frames)
-        if verbose:
-            print ('[' + int(prog_ratio * 50) * '=' + int((1 - prog_ratio) * 50) * '-' + ']'
-                   ' %.1f %% Complete\r' % (prog_ratio * 100)),
-        ret, frame = vid.read()
-        if ret:
-            # make sure two frames are written per one original frame (to
-            # maintain playback speed)
-            for j in range(2):
-                # make sure eye tracking data exists for current frame
-                if i < len(vts):
-                    # make sure eye tracking data is not ahead of video
-                    if vts[i] < vid_time:
-                        frame_cp = frame.copy()
-                        if gaze_val[i] == 0:
-                            gp_x = gaze_x[i]
-                            gp_y = gaze_y[i]
-                            cv2.circle(
-                                frame_cp, (int(1920 * gp_x), int(1080 * gp_y)),
-                                8, [255, 0, 0], -2)
-                        out.write(frame_cp)
-                        i += 1
-                    else:
-                        out.write(frame)
-                else:
-                    out.write(frame)
-        else:
-            break
-        # make sure eye tracking data is caught up with video
-        if i + 1 < len(vts):
-            while vts[i + 1] < vid_time:
-                i += 1
+    if pipelined:
+        pipeline(vid, out, shown, points, valid, trail, tot_frames,
+                 verbose=verbose)
+    else:
+        no_gaze = -np.ones(shown.shape[1], int)
+        f = 0
+        while(vid.isOpened()):
+            if verbose:
+                show_progress(f, tot_frames)
+            ret, frame = vid.read()
+            if not ret:
+                break
+            # the frame count is only an estimate, so show no gaze past its end
+            frames, drawn = gaze_frames(
+                frame, shown[f] if f < len(shown) else no_gaze, points,
+                valid, trail, lambda: None)
+            for out_frame in frames:
+                out.write(out_frame)
+            f += 1
     if verbose:
         print
         print "Done!"
@@ -89,8 +212,22 @@ def process(gaze_file, infile, outfile, verbose=True):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('video', help='Location of Tobii video file')
-    parser.add_argument('data', help='Location of gaze data csv file')
+    parser.add_argument('data', help='Location of gaze data file (csv, parquet or feather)')
     parser.add_argument('out_video', help='Name of output video with gaze')
+    parser.add_argument('--serial', action='store_true',
+                        help='Decode, draw and encode one frame at a time ' +
+                             'in a single thread')
+    parser.add_argument('-w', '--writer', choices=sorted(WRITERS),
+                        default='opencv',
+                        help='Video writer backend.  ffmpeg encodes H.264 ' +
+                             'at the native framerate, with gaze drawn as a ' +
+                             'trail.  Default is opencv.')
+    parser.add_argument('--preset', default='veryfast',
+                        help='x264 preset for the ffmpeg writer')
+    parser.add_argument('--crf', type=int, default=23,
+                        help='x264 constant rate factor for the ffmpeg writer')
     args = parser.parse_args()
 
-    process(args.data, args.video, args.out_video)
+    process(args.data, args.video, args.out_video,
+            pipelined=not args.serial, writer=args.writer,
+            preset=args.preset, crf=args.crf)
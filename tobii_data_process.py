@@ -6,156 +6,351 @@
 '''
 
 import argparse
+import hashlib
 import json
+import os
+import sys
+import time
+import zlib
 import pandas as pd
 import numpy as np
 
 
-def num_lines(fname):
-    with open(fname) as f:
-        for i, l in enumerate(f, start=1):
-            pass
-    return float(i)
+class ProgressBar(object):
+    """
+    Progress callback that draws a text progress bar.  Call it with the
+    fraction done; redraws are throttled to at most one per `interval`
+    seconds, except for the final one.
+    """
+    def __init__(self, interval=0.1, stream=sys.stdout):
+        self.interval = interval
+        self.stream = stream
+        self.last = None
 
+    def __call__(self, done):
+        now = time.time()
+        if (done < 1 and self.last is not None and
+                now - self.last < self.interval):
+            return
+        self.last = now
+        self.stream.write('[' + int(done * 50) * '=' +
+                          (50 - int(done * 50)) * '-' + ']' +
+                          ' %.1f %% Complete\r' % (done * 100))
+        self.stream.flush()
 
-def read_data(json_fname, verbose=True):
-    df = pd.DataFrame()
-    pts_sync = {}
-    vts_sync = {}
-    pulse_sync = {}
 
-    if verbose:
-        print "Estimating size..."
-    file_len = num_lines(json_fname)
+def iter_lines(fname, block_size=1 << 20):
+    """
+    Yields (line, fraction done) for a JSON lines file, decompressing it on
+    the fly if it is gzipped.  The file is read in large blocks and the
+    fraction done is measured in bytes of the file on disk, i.e. compressed
+    bytes for .gz input.
+    """
+    size = float(max(os.path.getsize(fname), 1))
+    if fname.endswith('.gz'):
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decomp = None
+
+    with open(fname, 'rb') as f:
+        tail = ''
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if decomp is not None:
+                data = decomp.decompress(block)
+                # start over for each member of a concatenated gzip file
+                while decomp.unused_data:
+                    unused = decomp.unused_data
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    data += decomp.decompress(unused)
+            else:
+                data = block
+            lines = (tail + data).split('\n')
+            tail = lines.pop()
+            done = f.tell() / size
+            for line in lines:
+                if line.strip():
+                    yield line, done
+        if decomp is not None:
+            tail += decomp.flush()
+        if tail.strip():
+            yield tail, 1.
+
+
+# columns filled by each record type, in the order read_data creates them.
+# Per-eye record types are prefixed with 'l' or 'r'.
+EYE_COLUMNS = {
+    'pc': ['_pup_cent_x', '_pup_cent_y', '_pup_cent_z', '_pup_cent_val'],
+    'pd': ['_pup_diam', '_pup_diam_val'],
+    'gd': ['_gaze_dir_x', '_gaze_dir_y', '_gaze_dir_z', '_gaze_dir_val'],
+}
+GAZE_COLUMNS = {
+    'gp': ['gaze_pos_x', 'gaze_pos_y', 'gaze_pos_val'],
+    'gp3': ['3d_gaze_pos_x', '3d_gaze_pos_y', '3d_gaze_pos_z',
+            '3d_gaze_pos_val'],
+}
+# pupil diameter columns that get cleaned
+PUPIL_COLUMNS = ('l_pup_diam', 'r_pup_diam')
+# columns the gaze overlay scripts need
+GAZE_POS_COLUMNS = ['gaze_pos_x', 'gaze_pos_y', 'gaze_pos_val', 'vts_time']
+# file extension for each output format
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+# timestamp columns keep float64 in binary formats; the tracker's own
+# measurements don't carry more precision than float32 holds
+TIME_COLUMNS = ('index', 'pts_time', 'vts_time', 'seconds')
+
+
+class RecordBuffer(object):
+    """
+    Growable typed arrays holding every sample of one record type.  Storage
+    doubles whenever it fills up, so appending is amortized constant time.
+    """
+    def __init__(self, columns, first_line, capacity=4096):
+        self.columns = columns
+        self.first_line = first_line
+        self.n = 0
+        self.ts = np.empty(capacity, dtype=np.int64)
+        self.line = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty((capacity, len(columns)), dtype=np.float64)
+
+    def append(self, line, ts, values):
+        if self.n == len(self.ts):
+            self._grow()
+        self.ts[self.n] = ts
+        self.line[self.n] = line
+        self.values[self.n] = values
+        self.n += 1
+
+    def _grow(self):
+        capacity = 2 * len(self.ts)
+        self.ts = np.resize(self.ts, capacity)
+        self.line = np.resize(self.line, capacity)
+        self.values = np.resize(self.values, (capacity, len(self.columns)))
+
+
+def build_frame(buffers):
+    """
+    Joins the record buffers on their timestamps into a single DataFrame.
+    Rows keep the order in which each timestamp first appeared in the file
+    and columns the order in which each record type first appeared.
+    """
+    buffers = sorted(buffers.values(), key=lambda b: b.first_line)
+    if len(buffers) == 0:
+        return pd.DataFrame()
+    lines = np.concatenate([b.line[:b.n] for b in buffers])
+    stamps = np.concatenate([b.ts[:b.n] for b in buffers])
+    order = np.argsort(lines, kind='mergesort')
+    index = pd.Index(pd.unique(stamps[order]))
+
+    columns = []
+    data = np.empty((len(index), sum(len(b.columns) for b in buffers)))
+    data.fill(np.nan)
+    for b in buffers:
+        rows = index.get_indexer(b.ts[:b.n])
+        # repeated timestamps keep the last sample, as df.loc did
+        data[rows, len(columns):len(columns) + len(b.columns)] = b.values[:b.n]
+        columns += b.columns
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def sync_times(stamps, sync):
+    """
+    Maps tobii timestamps onto the clock of a sync stream (pts or vts).  Each
+    timestamp is offset by the latest sync packet at or before it, and
+    timestamps that come before the first sync packet are NaN.
+    """
+    stamps = np.asarray(stamps)
+    synced = np.empty(len(stamps))
+    synced.fill(np.nan)
+    if len(sync) == 0:
+        return synced
+    keys = np.array(sorted(sync.keys()))
+    offsets = np.array([sync[k] for k in keys]) - keys
+    pos = np.searchsorted(keys, stamps, side='right') - 1
+    after = pos >= 0
+    synced[after] = stamps[after] + offsets[pos[after]]
+    return synced
+
+
+def align_frames(vts, frame_times):
+    """
+    Aligns gaze samples with video frames, given both as sorted times (ms).
+    Frame f gets the samples after the previous frame's time up to and
+    including its own, vts[bounds[f]:bounds[f + 1]] of the returned bounds
+    (the first frame also gets any samples before it).
+    """
+    bounds = np.searchsorted(vts, frame_times, side='right')
+    return np.concatenate(([0], bounds))
+
+
+def frame_samples(bounds, per_frame=2):
+    """
+    Picks up to `per_frame` gaze samples to show on each frame, given the
+    bounds from align_frames, taking the latest when a frame has more.
+    Returns sample indices of shape (frames, per_frame) in time order,
+    padded with -1.
+    """
+    lo, hi = bounds[:-1], bounds[1:]
+    shown = np.maximum(lo, hi - per_frame)[:, None] + np.arange(per_frame)
+    shown[shown >= hi[:, None]] = -1
+    return shown
+
+
+class RecordCollector(object):
+    """
+    Sorts tobii JSON entries, in the order they were recorded, into a record
+    buffer per record type plus the pts, vts and sync pulse streams, and
+    joins them into read_data's DataFrame on demand.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.pts_sync = {}
+        self.vts_sync = {}
+        self.pulse_sync = {}
+        self.n = 0
+
+    def add(self, entry):
+        self.n += 1
+        i = self.n
+        if entry['s'] != 0:
+            return
+        elif 'dir' in entry:
+            self.pulse_sync[entry['ts']] = entry['sig']
+        elif 'pts' in entry:
+            self.pts_sync[entry['ts']] = entry['pts']
+            return
+        elif 'vts' in entry:
+            self.vts_sync[entry['ts']] = entry['vts']
+            return
+        if 'eye' in entry:
+            which_eye = str(entry['eye'][:1])
+            if 'pc' in entry:
+                key, values = which_eye + 'pc', entry['pc'] + [entry['s']]
+            elif 'pd' in entry:
+                key, values = which_eye + 'pd', [entry['pd'], entry['s']]
+            elif 'gd' in entry:
+                key, values = which_eye + 'gd', entry['gd'] + [entry['s']]
+            else:
+                return
+            if key not in self.buffers:
+                self.buffers[key] = RecordBuffer(
+                    [which_eye + c for c in EYE_COLUMNS[key[1:]]], i)
+        else:
+            if 'gp' in entry:
+                key, values = 'gp', entry['gp'] + [entry['s']]
+            elif 'gp3' in entry:
+                key, values = 'gp3', entry['gp3'] + [entry['s']]
+            else:
+                return
+            if key not in self.buffers:
+                self.buffers[key] = RecordBuffer(GAZE_COLUMNS[key], i)
+        self.buffers[key].append(i, entry['ts'], values)
+
+    def frame(self):
+        df = build_frame(self.buffers)
+        df['pts_time'] = sync_times(df.index, self.pts_sync)
+        df['vts_time'] = sync_times(df.index, self.vts_sync)
+        return df
+
+
+def read_data(json_fname, verbose=True, progress=None):
+    """
+    Reads a tobii JSON (or .json.gz) file into a DataFrame indexed by
+    timestamp, along with a dict of sync pulses.  `progress` is called with
+    the fraction of the file read so far, once per block; by default a
+    ProgressBar is drawn when verbose.
+    """
+    collector = RecordCollector()
 
     if verbose:
         print "Converting JSON..."
-    with open(json_fname) as f:
-        i = 0
-        for line in f:
-            entry = json.loads(line)
-            i += 1
-            if verbose:
-                print ('[' + int((i / file_len) * 50) * '=' + int((1 - i / file_len) * 50) * '-' + ']'
-                       ' %.1f %% Complete\r' % ((i / file_len) * 100)),
-            if entry['s'] != 0:
-                continue
-            elif 'dir' in entry.keys():
-                pulse_sync[entry['ts']] = entry['sig']
-            elif 'pts' in entry.keys():
-                pts_sync[entry['ts']] = entry['pts']
-                continue
-            elif 'vts' in entry.keys():
-                vts_sync[entry['ts']] = entry['vts']
-                continue
-            if 'eye' in entry.keys():
-                which_eye = entry['eye'][:1]
-                if 'pc' in entry.keys():
-                    df.loc[entry['ts'],
-                           which_eye + '_pup_cent_x'] = entry['pc'][0]
-                    df.loc[entry['ts'],
-                           which_eye + '_pup_cent_y'] = entry['pc'][1]
-                    df.loc[entry['ts'],
-                           which_eye + '_pup_cent_z'] = entry['pc'][2]
-                    df.loc[entry['ts'],
-                           which_eye + '_pup_cent_val'] = entry['s']
-                elif 'pd' in entry.keys():
-                    df.loc[entry['ts'],
-                           which_eye + '_pup_diam'] = entry['pd']
-                    df.loc[entry['ts'],
-                           which_eye + '_pup_diam_val'] = entry['s']
-                elif 'gd' in entry.keys():
-                    df.loc[entry['ts'],
-                           which_eye + '_gaze_dir_x'] = entry['gd'][0]
-                    df.loc[entry['ts'],
-                           which_eye + '_gaze_dir_y'] = entry['gd'][1]
-                    df.loc[entry['ts'],
-                           which_eye + '_gaze_dir_z'] = entry['gd'][2]
-                    df.loc[entry['ts'],
-                           which_eye + '_gaze_dir_val'] = entry['s']
-            else:
-                if 'gp' in entry.keys():
-                    df.loc[entry['ts'], 'gaze_pos_x'] = entry['gp'][0]
-                    df.loc[entry['ts'], 'gaze_pos_y'] = entry['gp'][1]
-                    df.loc[entry['ts'],
-                           'gaze_pos_val'] = entry['s']
-                elif 'gp3' in entry.keys():
-                    df.loc[entry['ts'],
-                           '3d_gaze_pos_x'] = entry['gp3'][0]
-                    df.loc[entry['ts'],
-                           '3d_gaze_pos_y'] = entry['gp3'][1]
-                    df.loc[entry['ts'],
-                           '3d_gaze_pos_z'] = entry['gp3'][2]
-                    df.loc[entry['ts'],
-                           '3d_gaze_pos_val'] = entry['s']
-
-    df['pts_time'] = np.array(df.index)
-    df.ix[df.index < min(sorted(pts_sync.keys())), 'pts_time'] = np.nan
-    df['vts_time'] = np.array(df.index)
-    df.ix[df.index < min(sorted(vts_sync.keys())), 'vts_time'] = np.nan
-
-    for key in sorted(pts_sync.keys()):
-        df.ix[df.index >= key, 'pts_time'] = np.array(
-            df.index)[df.index >= key]
-        df.ix[df.index >= key, 'pts_time'] = df.pts_time - key + pts_sync[key]
-
-    for key in sorted(vts_sync.keys()):
-        df.ix[df.index >= key, 'vts_time'] = np.array(
-            df.index)[df.index >= key]
-        df.ix[df.index >= key, 'vts_time'] = df.vts_time - key + vts_sync[key]
+    if progress is None and verbose:
+        progress = ProgressBar()
+    last_done = None
+    for line, done in iter_lines(json_fname):
+        entry = json.loads(line)
+        if progress is not None and done != last_done:
+            progress(done)
+            last_done = done
+        collector.add(entry)
+
+    if progress is not None:
+        progress(1.)
+    df = collector.frame()
     if verbose:
         print
-    return df, pulse_sync
+    return df, collector.pulse_sync
 
 def window_diff(data, width):
     """
     Takes a series and calculates a diff between each value and the mean of
     values surrounding it (dictated by width) If this window extends past the
     data's indices, it will ignore those values.
+
+    Window sums come from cumulative sums of the values and of the non-NaN
+    counts, so the whole series is handled in O(N) regardless of width.
     """
-    diff = data.copy()
-    for i in range(len(data)):
-        if i < width:
-            win_m = (np.nanmean(data[:i]) + np.nanmean(data[i+1:i+1+width]))/2
-        else:
-            win_m = (np.nanmean(data[i-width:i]) + np.nanmean(data[i+1:i+1+width]))/2
-        diff[i] -= win_m
-    return diff
+    values = np.asarray(data, dtype=np.float64)
+    n = len(values)
+    valid = ~np.isnan(values)
+    csum = np.concatenate(([0.], np.cumsum(np.where(valid, values, 0.))))
+    ccount = np.concatenate(([0], np.cumsum(valid)))
 
-def cleanseries(data, *args):
-    if data.name != 'l_pup_diam' and data.name != 'r_pup_diam':
-        return data
-    interp_type = args[0]
-    bad = (data == 0)
-
-    dd = window_diff(data, 10)
-    sig = np.nanmedian(np.absolute(dd) / 0.67449)
-    th = 5
-    disc = np.absolute(dd) > th * sig
-
-    to_remove = np.nonzero(bad | disc)[0]
-    up_one = range(len(to_remove))
-    for i in range(len(to_remove)):
-        up_one[i] = to_remove[i] + 1
-    down_one = range(len(to_remove))
-    for i in range(len(to_remove)):
-        down_one[i] = to_remove[i] - 1
-    isolated = np.intersect1d(up_one, down_one)
-
-    allbad = np.union1d(to_remove, isolated)
-
-    newdat = data.copy()
-    newdat[allbad] = np.nan
-
-    goodinds = np.nonzero(np.invert(np.isnan(newdat)))[0]
-    if len(goodinds) == 0:
+    inds = np.arange(n)
+    left_lo = np.maximum(inds - width, 0)
+    right_hi = np.minimum(inds + 1 + width, n)
+    left_sum = csum[inds] - csum[left_lo]
+    left_count = ccount[inds] - ccount[left_lo]
+    right_sum = csum[right_hi] - csum[inds + 1]
+    right_count = ccount[right_hi] - ccount[inds + 1]
+
+    # empty or all-NaN windows have no mean, matching np.nanmean
+    with np.errstate(divide='ignore', invalid='ignore'):
+        win_m = (left_sum / left_count + right_sum / right_count) / 2
+    return data - win_m
+
+
+def outlier_mask(data, width=10, th=5):
+    """
+    Flags samples to remove from a pupil diameter series: blinks (zeros),
+    discontinuities more than `th` robust standard deviations away from the
+    surrounding window mean, and samples isolated between two flagged ones.
+    """
+    data = np.asarray(data)
+    dd = np.absolute(window_diff(data, width))
+    sig = np.nanmedian(dd / 0.67449)
+    with np.errstate(invalid='ignore'):
+        mask = (data == 0) | (dd > th * sig)
+    isolated = np.zeros_like(mask)
+    isolated[1:-1] = mask[:-2] & mask[2:]
+    mask |= isolated
+    return mask
+
+
+def cleanseries(data, interp_type):
+    """
+    Removes outliers from a float array of pupil diameters (float32 or
+    float64) and interpolates over them, 1 for linear and 2 for polynomial.
+    The array is cleaned in place and returned.
+    """
+    mask = outlier_mask(data)
+    if np.all(mask | np.isnan(data)):
         print "Not enough good data to clean. Aborting."
         return data
-    else:
-        if interp_type == 1:
-            return pd.Series.interpolate(newdat, method='linear')
-        elif interp_type == 2:
-            return pd.Series.interpolate(newdat, method='polynomial', order=3)
+    data[mask] = np.nan
+
+    if interp_type == 1:
+        # same as pandas' linear interpolation: leading NaNs are kept and
+        # trailing NaNs take the last good value
+        good = np.nonzero(~np.isnan(data))[0]
+        fill = np.arange(good[0], len(data))
+        data[fill] = np.interp(fill, good, data[good])
+    elif interp_type == 2:
+        data[:] = pd.Series(data).interpolate(method='polynomial',
+                                              order=3).values
+    return data
 
 
 # adds 'seconds' column that converts tobii timestamps to seconds
@@ -166,20 +361,84 @@ def add_seconds(df):
     return df
 
 
-def process(tobii_in, clean, verbose=True):
-    df, pulses = read_data(tobii_in, verbose=verbose)
+def output_base(tobii_in):
+    """
+    Path that process' outputs are named from: the input without its .json
+    or .json.gz extension.
+    """
+    if tobii_in.endswith('.gz'):
+        tobii_in = tobii_in[:-3]
+    return os.path.splitext(tobii_in)[0]
+
+
+def file_stamp(path, sample=1 << 20):
+    """
+    Cheap fingerprint of a file: its size and mtime, plus a hash of its size
+    and its first and last `sample` bytes.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size))
+    with open(path, 'rb') as f:
+        digest.update(f.read(sample))
+        if size > sample:
+            f.seek(max(sample, size - sample))
+            digest.update(f.read(sample))
+    return {'size': size, 'mtime': os.path.getmtime(path),
+            'hash': digest.hexdigest()}
+
+
+def write_data(df, path, out_format='csv'):
+    """
+    Writes processed data as csv, or as a columnar binary file (parquet or
+    feather, which need pyarrow) with float32 measurements.  Parquet is
+    snappy compressed; feather is left as pyarrow writes it, which is only
+    compressed from pyarrow 0.17, but is the quickest to load.
+    """
+    if out_format == 'csv':
+        df.to_csv(path)
+        return
+    # feather can't store an index, so both binary formats keep it as the
+    # 'index' column, just as it comes back from read_csv
+    df = df.reset_index()
+    for col in df.columns:
+        if col not in TIME_COLUMNS:
+            df[col] = df[col].astype(np.float32)
+    if out_format == 'parquet':
+        df.to_parquet(path, compression='snappy')
+    elif out_format == 'feather':
+        df.to_feather(path)
+    else:
+        raise ValueError('Unknown output format: %s' % out_format)
+
+
+def load_data(path, columns=None):
+    """
+    Loads processed data written by process in any output format, reading
+    only `columns` if given.
+    """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    elif path.endswith('.feather'):
+        return pd.read_feather(path, columns=columns)
+    else:
+        return pd.read_csv(path, usecols=columns)
+
+
+def process(tobii_in, clean, verbose=True, progress=None, out_format='csv'):
+    df, pulses = read_data(tobii_in, verbose=verbose, progress=progress)
 
     if int(clean) in (1, 2):
         if verbose:
             print "Cleaning data..."
-        df = df.reset_index()
-        df = df.apply(cleanseries, args=[int(args.clean)])
-        df = df.set_index('index', drop=True)
+        for col in PUPIL_COLUMNS:
+            if col in df:
+                df[col] = cleanseries(df[col].values.copy(), int(clean))
     df = add_seconds(df)
 
-    df.to_csv(tobii_in.split('.')[0] + '.csv')
+    out_base = output_base(tobii_in)
+    write_data(df, out_base + OUTPUT_FORMATS[out_format], out_format)
     if len(pulses) > 0:
-        with open(tobii_in.split('.')[0] + '_sync_pulses.json', 'w') as f:
+        with open(out_base + '_sync_pulses.json', 'w') as f:
             json.dump(pulses, f)
     if verbose:
         print "Done!"
@@ -187,9 +446,12 @@ def process(tobii_in, clean, verbose=True):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'tobii_in', help='Location of tobii JSON file to convert')
+        'tobii_in', help='Location of tobii JSON file (or .json.gz) to convert')
     parser.add_argument('--clean', default=0, help='Flag to clean pupil size data, 1 for linear interpolation, ' +
                                                    '2 for polynomial interpolation. Default is no cleaning.')
+    parser.add_argument('--format', default='csv', choices=sorted(OUTPUT_FORMATS),
+                        help='Output format. parquet (compressed) and feather (fastest to load) ' +
+                             'are binary formats that require pyarrow. Default is csv.')
     args = parser.parse_args()
 
-    process(args.tobii_in, args.clean)
+    process(args.tobii_in, args.clean, out_format=args.format)
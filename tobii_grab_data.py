@@ -25,7 +25,7 @@ This will be arranged into this folder structure:
 <Name of format JSON file>
     <id>
         <trial_name>.mp4
-        <trial_name>.json
+        <trial_name>.json.gz
         ...
     ...
 """
@@ -34,12 +34,17 @@ import json
 import os
 from glob import glob
 from shutil import copyfile
-import gzip
-from tobii_data_process import process
+from tobii_data_process import process, output_base, file_stamp, \
+    ProgressBar, OUTPUT_FORMATS
+import multiprocessing
+import Queue
 import sys
+import threading
+import traceback
 
 
-def transfer_data(card, format_json, convert, verbose=True):
+def transfer_data(card, format_json, convert, jobs=1, out_format='csv',
+                  verbose=True):
     """
     Transfers data from SD card
     """
@@ -137,55 +142,258 @@ def transfer_data(card, format_json, convert, verbose=True):
                 else:
                     raise Exception('No segments found for id: ' % info['id'])
 
-    if verbose:
-        print "Tranferring and unzipping data..."
+    # copy gaze data before videos so conversion can start right away
+    transfers.sort(key=lambda t: not t[1].endswith('.json.gz'))
 
-    unzipped = move_and_unzip(transfers, verbose=verbose)
+    # skip whatever an earlier (possibly interrupted) run already finished
+    manifest = Manifest(format_json.split('.json')[0] + '_manifest.json')
+    stamps = dict((source, file_stamp(source)) for source, dest in transfers)
+    to_copy = [(source, dest) for source, dest in transfers
+               if not manifest.is_copied(dest, stamps[source])]
+    if verbose and len(to_copy) < len(transfers):
+        print "Skipping %i file(s) already transferred..." % (
+            len(transfers) - len(to_copy))
 
     if convert in (0, 1, 2):
+        recopied = set(dest for source, dest in to_copy)
+        to_convert = [dest for source, dest in transfers
+                      if dest.endswith('.json.gz') and
+                      (dest in recopied or
+                       not manifest.is_converted(dest, convert, out_format))]
         if verbose:
-            print "Converting data into csv..."
-            sys.stdout.write('  0.00%')
-            i = 0.0
+            print "Tranferring and converting data..."
+        # convert_data takes recordings off as soon as they arrive, so the
+        # copy thread only waits here if conversion falls far behind
+        copied = Queue.Queue(maxsize=2 * max(jobs, 1))
+        # recordings that were copied but not converted go first
+        ready = [dest for dest in to_convert if dest not in recopied]
+        copy_errors = []
+        copier = threading.Thread(
+            target=copy_worker,
+            args=[to_copy, stamps, manifest, set(to_convert), copied,
+                  copy_errors, ready])
+        copier.daemon = True
+        copier.start()
 
-        for tobii_data in unzipped:
-            process(tobii_data, convert, verbose=False)
-            if verbose:
-                i += 1
-                sys.stdout.write('\r' + '%6.2f%%' % ((i / len(unzipped)) * 100))
-                sys.stdout.flush()
+        failed = convert_data(iter(copied.get, None), convert, jobs=jobs,
+                              total=len(to_convert), manifest=manifest,
+                              out_format=out_format, verbose=verbose)
+        copier.join()
+        # reported before any copy error is raised, so neither is lost
+        if failed:
+            print
+            print "Failed to convert %i recording(s):" % len(failed)
+            for tobii_data, error in failed:
+                print tobii_data
+                print error
+        if copy_errors:
+            raise Exception('Transfer from SD card failed:\n' +
+                            copy_errors[0])
+    else:
+        if verbose:
+            print "Tranferring data..."
+        move_data(to_copy, stamps, manifest, verbose=verbose)
 
     if verbose:
         print
         print "Done!"
 
 
-def move_and_unzip(transfers, verbose=True):
-    unzipped = []
+class Manifest(object):
+    """
+    Record of the files transferred (and converted) so far, kept as JSON
+    next to the format file.  It is saved after every file, so a rerun skips
+    finished work and an interrupted transfer resumes where it stopped.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.base = os.path.dirname(os.path.abspath(path))
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def _key(self, dest):
+        return os.path.relpath(os.path.abspath(dest), self.base)
+
+    def is_copied(self, dest, stamp):
+        entry = self.entries.get(self._key(dest))
+        return (entry is not None and os.path.exists(dest) and
+                os.path.getsize(dest) == stamp['size'] and
+                all(entry[k] == stamp[k] for k in ('size', 'mtime', 'hash')))
+
+    def is_converted(self, dest, convert, out_format='csv'):
+        entry = self.entries.get(self._key(dest))
+        return (entry is not None and entry.get('converted') == convert and
+                os.path.exists(output_base(dest) +
+                               OUTPUT_FORMATS[out_format]))
+
+    def mark_copied(self, dest, stamp):
+        with self.lock:
+            self.entries[self._key(dest)] = dict(stamp)
+            self._save()
+
+    def mark_converted(self, dest, convert):
+        with self.lock:
+            self.entries[self._key(dest)]['converted'] = convert
+            self._save()
+
+    def _save(self):
+        # write then rename, so an interruption never leaves half a manifest
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True,
+                      separators=(',', ': '))
+        os.rename(tmp, self.path)
 
+
+class QueueProgress(object):
+    """
+    Progress callback for worker processes that forwards (index, fraction
+    done) to the parent through a queue.
+    """
+    def __init__(self, queue, index):
+        self.queue = queue
+        self.index = index
+
+    def __call__(self, done):
+        self.queue.put((self.index, done))
+
+
+def convert_recording(task):
+    """
+    Converts one recording to csv.  Errors are returned as a formatted
+    traceback rather than raised, so one bad segment doesn't abort the batch.
+    """
+    tobii_data, convert, out_format, progress = task
+    try:
+        process(tobii_data, convert, verbose=False, progress=progress,
+                out_format=out_format)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def convert_data(recordings, convert, jobs=1, total=None, manifest=None,
+                 out_format='csv', verbose=True):
+    """
+    Converts recordings to csv, spread over `jobs` processes when jobs > 1,
+    while showing their combined progress.  `recordings` can be any iterable,
+    such as one fed by the copy thread, with `total` giving its length.
+    Successful conversions are recorded in `manifest` as they finish.
+    Returns (recording, error) pairs for the recordings that failed.
+    """
+    if total is None:
+        total = len(recordings)
+    done = [0.] * total
+    started = []
+    errors = {}
+    if verbose:
+        bar = ProgressBar()
+
+    def update(index, frac):
+        done[index] = frac
+        if verbose:
+            bar(sum(done) / max(total, 1))
+
+    def finished(index, error):
+        errors[index] = error
+        if error is None and manifest is not None:
+            manifest.mark_converted(started[index], convert)
+
+    if jobs > 1:
+        queue = multiprocessing.Manager().Queue()
+        pool = multiprocessing.Pool(jobs)
+        pending = {}
+        lock = threading.Lock()
+
+        def submit():
+            for i, tobii_data in enumerate(recordings):
+                with lock:
+                    started.append(tobii_data)
+                    pending[i] = pool.apply_async(
+                        convert_recording,
+                        [(tobii_data, convert, out_format,
+                          QueueProgress(queue, i))])
+
+        # recordings can be slow to arrive (waiting on the copy thread), so
+        # they are submitted from another thread while this one collects
+        # results and shows progress
+        submitter = threading.Thread(target=submit)
+        submitter.daemon = True
+        submitter.start()
+        while submitter.is_alive() or pending or not queue.empty():
+            with lock:
+                results = [(i, pending.pop(i).get())
+                           for i, r in pending.items() if r.ready()]
+            for i, error in results:
+                finished(i, error)
+            try:
+                update(*queue.get(timeout=0.1))
+            except Queue.Empty:
+                pass
+        pool.close()
+        pool.join()
+    else:
+        for i, tobii_data in enumerate(recordings):
+            started.append(tobii_data)
+            finished(i, convert_recording(
+                (tobii_data, convert, out_format,
+                 lambda frac, i=i: update(i, frac))))
+
+    return [(started[i], errors[i]) for i in range(len(started))
+            if errors[i] is not None]
+
+
+def copy_file(source, dest):
+    dest_dir = os.path.dirname(dest)
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    copyfile(source, dest)
+
+
+def copy_worker(transfers, stamps, manifest, to_convert, copied, errors,
+                ready=()):
+    """
+    Copies files off the card on a background thread, recording each one in
+    the manifest and putting gaze data that needs converting on the `copied`
+    queue as soon as it is on disk, after the already copied `ready` ones.
+    None marks the end, and a failed copy stops the transfer and is appended
+    to `errors`.
+    """
+    try:
+        for dest in ready:
+            copied.put(dest)
+        for source, dest in transfers:
+            copy_file(source, dest)
+            manifest.mark_copied(dest, stamps[source])
+            if dest in to_convert:
+                copied.put(dest)
+    except Exception:
+        errors.append(traceback.format_exc())
+    finally:
+        copied.put(None)
+
+
+def move_data(transfers, stamps, manifest, verbose=True):
+    """
+    Copies files off the card, recording each one in the manifest.  The gaze
+    data stays gzipped, since tobii_data_process reads .json.gz directly.
+    """
     if verbose:
         sys.stdout.write('  0.00%')
         i = 0.0
 
     for source, dest in transfers:
-        dest_dir = os.path.dirname(dest)
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-        copyfile(source, dest)
-        if dest.endswith('.gz'):
-            unzip_dest = dest.split('.gz')[0]
-            with gzip.open(dest) as infile:
-                with open(unzip_dest, 'w+') as outfile:
-                    for line in infile:
-                        outfile.write(line)
-            os.remove(dest)
-            unzipped.append(unzip_dest)
+        copy_file(source, dest)
+        manifest.mark_copied(dest, stamps[source])
         if verbose:
             i += 1
             sys.stdout.write('\r' + '%6.2f%%' % ((i / len(transfers)) * 100))
             sys.stdout.flush()
     print
-    return unzipped
 
 
 if __name__ == '__main__':
@@ -202,6 +410,15 @@ if __name__ == '__main__':
                           ' interpolation. 2 for cleaning with polynomial' +
                           ' interpolation.',
         default=-1)
+    parser.add_argument(
+        '--jobs', help='Number of recordings to convert in parallel.',
+        type=int, default=1)
+    parser.add_argument(
+        '--out-format', help='Format of converted data: csv, or the' +
+                             ' binary parquet (compressed) or feather' +
+                             ' (fastest to load), which require pyarrow.',
+        choices=sorted(OUTPUT_FORMATS), default='csv')
     args = parser.parse_args()
 
-    transfer_data(args.card, args.format, int(args.convert))
+    transfer_data(args.card, args.format, int(args.convert), jobs=args.jobs,
+                  out_format=args.out_format)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+'''
+    Live view of the scene camera of Tobii Glasses 2 with the latest gaze
+    point drawn on it, for checking calibration during a session.  The live
+    video stream (MPEG-TS) is decoded by ffmpeg with its low latency options,
+    and gaze comes from the live data stream.
+
+    Only the newest decoded frame is ever shown: frames that are replaced
+    before they can be drawn are dropped rather than queued.  Once a second
+    the frame rate, dropped frames and latency are reported, where frame
+    latency runs from the datagram carrying the start of a frame arriving
+    (matched to the decoded frame by its PTS) and gaze latency from the gaze
+    sample arriving, both until the frame is shown.  Press q to quit.
+'''
+import argparse
+from collections import OrderedDict
+import cv2
+import numpy as np
+import socket
+import sys
+import threading
+import time
+from tobii_record import GlassesClient, KeepAlive, LiveDataReceiver, \
+    GLASSES_IP, PORT
+from tobii_video import FFmpegDecoder, ts_video_pts
+
+
+class FrameArrivals(object):
+    """
+    When the start of each video frame arrived, by PTS.  Frames that never
+    come out of the decoder are forgotten after `max_age` seconds, which is
+    long enough to cover waiting for a keyframe when joining the stream.
+    """
+    def __init__(self, max_age=60.):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.arrived = OrderedDict()
+
+    def add(self, pts, arrived):
+        with self.lock:
+            # a looping stream can repeat a PTS, so move it to the end
+            self.arrived.pop(pts, None)
+            self.arrived[pts] = arrived
+            while next(self.arrived.itervalues()) < arrived - self.max_age:
+                self.arrived.popitem(last=False)
+
+    def pop(self, pts):
+        with self.lock:
+            return self.arrived.pop(pts, None)
+
+
+class LatestFrame(object):
+    """
+    Holds the newest decoded frame, with when it arrived, until it's taken.
+    A frame replaced before being taken is counted in `dropped`.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.frame = None
+        self.arrived = None
+        self.dropped = 0
+        self.ended = False
+
+    def put(self, frame, arrived):
+        with self.cond:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.arrived = arrived
+            self.cond.notify()
+
+    def end(self):
+        with self.cond:
+            self.ended = True
+            self.cond.notify()
+
+    def take(self, timeout=0.1):
+        """
+        Returns (frame, time arrived), waiting up to `timeout` seconds for
+        one, or (None, None).
+        """
+        with self.cond:
+            if self.frame is None and not self.ended:
+                self.cond.wait(timeout)
+            frame, arrived = self.frame, self.arrived
+            self.frame = None
+            return frame, arrived
+
+
+class LatestGaze(object):
+    """
+    Live data subscriber that keeps the latest valid gaze position and when
+    it arrived.
+    """
+    def __init__(self):
+        self.arrived = None
+        self.gp = None
+
+    def __call__(self, arrived, entry):
+        if 'gp' in entry and entry.get('s') == 0:
+            self.arrived, self.gp = arrived, entry['gp']
+
+
+def feed_video(sock, decoder, arrivals, running):
+    sock.settimeout(0.1)
+    while running.is_set():
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        now = time.time()
+        for pts in ts_video_pts(data):
+            arrivals.add(pts, now)
+        try:
+            decoder.feed(data)
+        except (IOError, ValueError):
+            # the decoder was closed
+            break
+
+
+def decode_video(decoder, arrivals, latest):
+    while True:
+        frame = decoder.read()
+        if frame is None:
+            break
+        latest.put(frame, arrivals.pop(decoder.pts))
+    latest.end()
+
+
+class LatencyReport(object):
+    """
+    Collects frame and gaze latencies, printing a summary every `interval`
+    seconds.
+    """
+    def __init__(self, interval=1.):
+        self.interval = interval
+        self.start = time.time()
+        self.frames = 0
+        self.dropped = 0
+        self.frame_latency = []
+        self.gaze_latency = []
+
+    def add(self, shown, arrived, gaze_arrived):
+        self.frames += 1
+        if arrived is not None:
+            self.frame_latency.append(shown - arrived)
+        if gaze_arrived is not None:
+            self.gaze_latency.append(shown - gaze_arrived)
+
+    def report(self, dropped, force=False):
+        now = time.time()
+        if not force and now - self.start < self.interval:
+            return
+        msg = '%5.1f fps, %3i dropped' % (
+            self.frames / max(now - self.start, 1e-6), dropped - self.dropped)
+        for name, latency in (('frame', self.frame_latency),
+                              ('gaze', self.gaze_latency)):
+            if latency:
+                msg += ', %s latency %5.1f ms (max %5.1f)' % (
+                    name, 1000 * np.mean(latency), 1000 * np.max(latency))
+        print msg
+        sys.stdout.flush()
+        self.__init__(self.interval)
+        self.dropped = dropped
+
+
+def live_view(glasses, size=(1920, 1080), show=True, duration=None):
+    """
+    Shows (or with show=False, only reports on) the live view from a
+    GlassesClient until q is pressed, the stream ends or `duration` seconds
+    have passed.
+    """
+    keepalive = KeepAlive()
+    data_socket, video_socket = glasses.live_sockets(keepalive)
+    keepalive.start()
+    receiver = LiveDataReceiver(data_socket)
+    gaze = LatestGaze()
+    receiver.subscribe(gaze)
+    receiver.start()
+
+    decoder = FFmpegDecoder(size, timestamps=True)
+    arrivals = FrameArrivals()
+    latest = LatestFrame()
+    running = threading.Event()
+    running.set()
+    threads = [threading.Thread(target=feed_video,
+                                args=[video_socket, decoder, arrivals,
+                                      running]),
+               threading.Thread(target=decode_video,
+                                args=[decoder, arrivals, latest])]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    report = LatencyReport()
+    start = time.time()
+    try:
+        while duration is None or time.time() - start < duration:
+            frame, arrived = latest.take()
+            if frame is None:
+                if latest.ended:
+                    break
+                continue
+            gaze_arrived, gp = gaze.arrived, gaze.gp
+            if gp is not None:
+                cv2.circle(frame, (int(size[0] * gp[0]), int(size[1] * gp[1])),
+                           8, [255, 0, 0], -2)
+            if show:
+                cv2.imshow('Tobii live view', frame)
+                if cv2.waitKey(1) & 0xff == ord('q'):
+                    break
+            report.add(time.time(), arrived, gaze_arrived)
+            report.report(latest.dropped)
+    finally:
+        running.clear()
+        threads[0].join()
+        decoder.close()
+        threads[1].join()
+        receiver.stop()
+        keepalive.stop()
+        if show:
+            cv2.destroyAllWindows()
+    report.report(latest.dropped, force=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--ip', default=GLASSES_IP,
+        help='IP address of the glasses. Default is %s.' % GLASSES_IP)
+    parser.add_argument(
+        '--live-port', type=int, default=PORT,
+        help='Port of the glasses live streams. Default is %i.' % PORT)
+    parser.add_argument(
+        '--size', type=int, nargs=2, default=[1920, 1080],
+        help='Size to show the video at. Default is 1920 1080.')
+    parser.add_argument(
+        '--no-window', action='store_true',
+        help='Only report frame rate and latency, without showing the video.')
+    args = parser.parse_args()
+
+    live_view(GlassesClient(args.ip, live_port=args.live_port),
+              size=tuple(args.size), show=not args.no_window)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+'''
+    Stand-in for a pair of Tobii Glasses 2, for trying out tobii_record
+    without the hardware.  It serves the parts of the REST API tobii_record
+    uses (over HTTP/1.1, so connections are kept alive), and streams made up
+    gaze data back to anything that sends it a live data keep-alive.
+
+    Calibrations finish `calibration_time` seconds after they are started,
+    and the time each recording was started is kept in `started`.  Given an
+    MPEG-TS video file, it is also streamed (on a loop) to anything that
+    sends a live video keep-alive.
+'''
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import math
+import socket
+import SocketServer
+import threading
+import time
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(self.server.glasses.handle('GET', self.path, None))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else 'null'
+        self.respond(self.server.glasses.handle('POST', self.path,
+                                                json.loads(body)))
+
+    def respond(self, data):
+        if data is None:
+            self.send_response(404)
+            data = {'error': 'Not found'}
+        else:
+            self.send_response(200)
+        body = json.dumps(data)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def finish_request(self, request, client_address):
+        self.glasses.connections += 1
+        BaseHTTPServer.HTTPServer.finish_request(self, request,
+                                                 client_address)
+
+
+class MockGlasses(object):
+    """
+    Serves the REST API on `http_port` and the live data stream on
+    `live_port` of `host` (0 picks a free port; see the attributes of the
+    same names once started).  Live data is sent at `data_rate` Hz, and the
+    `video` file if given at `video_bitrate` bits per second.
+    """
+    def __init__(self, host='127.0.0.1', http_port=0, live_port=0,
+                 calibration_time=0.5, data_rate=100., video=None,
+                 video_bitrate=4e6):
+        self.calibration_time = calibration_time
+        self.data_rate = data_rate
+        self.video = video
+        self.video_bitrate = video_bitrate
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.calibrations = {}
+        self.recordings = {}
+        self.started = {}
+        self.requests = 0
+        self.connections = 0
+        self.live_peers = {}
+        self.video_peers = {}
+
+        self.server = MockServer((host, http_port), MockHandler)
+        self.server.glasses = self
+        self.live = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.live.bind((host, live_port))
+        self.live.settimeout(0.1)
+        self.host = host
+        self.http_port = self.server.server_address[1]
+        self.live_port = self.live.getsockname()[1]
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.server.serve_forever),
+                        threading.Thread(target=self._keepalives),
+                        threading.Thread(target=self._stream)]
+        if self.video is not None:
+            self.threads.append(threading.Thread(target=self._stream_video))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.live.close()
+
+    def handle(self, method, path, data):
+        """
+        Returns the JSON response for a request, or None if there isn't one.
+        """
+        parts = path.strip('/').split('/')
+        with self.lock:
+            self.requests += 1
+            if parts[:1] != ['api'] or len(parts) < 2:
+                return None
+            kind, rest = parts[1], parts[2:]
+            if method == 'POST' and not rest:
+                new_id = '%s%i' % (kind[:2], next(self.ids))
+                if kind == 'projects':
+                    return {'pr_id': new_id}
+                elif kind == 'participants':
+                    return {'pa_id': new_id}
+                elif kind == 'calibrations':
+                    self.calibrations[new_id] = None
+                    return {'ca_id': new_id}
+                elif kind == 'recordings':
+                    self.recordings[new_id] = 'init'
+                    return {'rec_id': new_id}
+            elif kind == 'calibrations' and rest[0] in self.calibrations:
+                if rest[1:] == ['start']:
+                    self.calibrations[rest[0]] = time.time()
+                    return {}
+                elif rest[1:] == ['status']:
+                    started = self.calibrations[rest[0]]
+                    if started is None:
+                        return {'ca_state': 'uncalibrated'}
+                    if time.time() - started < self.calibration_time:
+                        return {'ca_state': 'calibrating'}
+                    return {'ca_state': 'calibrated'}
+            elif kind == 'recordings' and rest[0] in self.recordings:
+                if rest[1:] == ['start']:
+                    self.started[rest[0]] = time.time()
+                    self.recordings[rest[0]] = 'recording'
+                    return {}
+                elif rest[1:] == ['stop']:
+                    self.recordings[rest[0]] = 'done'
+                    return {}
+                elif rest[1:] == ['status']:
+                    return {'rec_state': self.recordings[rest[0]]}
+        return None
+
+    def _keepalives(self):
+        while self.running:
+            try:
+                msg, peer = self.live.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            try:
+                stream = json.loads(msg).get('type')
+            except ValueError:
+                continue
+            if stream == 'live.data.unicast':
+                self.live_peers[peer] = time.time()
+            elif stream == 'live.video.unicast':
+                self.video_peers[peer] = time.time()
+
+    def _stream(self):
+        start = time.time()
+        n = 0
+        while self.running:
+            now = time.time()
+            ts = int((now - start) * 1e6)
+            # gaze wanders slowly in a circle around the middle of the view
+            angle = 2 * math.pi * (now - start) / 5.
+            entry = {'ts': ts, 's': 0, 'gidx': n,
+                     'gp': [0.5 + 0.3 * math.cos(angle),
+                            0.5 + 0.3 * math.sin(angle)],
+                     'l': 0}
+            msg = json.dumps(entry)
+            # peers stop getting data a few seconds after their last keep-alive
+            for peer, last in self.live_peers.items():
+                if now - last < 3:
+                    try:
+                        self.live.sendto(msg, peer)
+                    except socket.error:
+                        pass
+            n += 1
+            time.sleep(max(0, start + n / self.data_rate - time.time()))
+
+    def _stream_video(self):
+        with open(self.video, 'rb') as f:
+            video = f.read()
+        # 7 transport stream packets per datagram, as is usual over UDP
+        size = 7 * 188
+        start = time.time()
+        sent = 0
+        while self.running:
+            now = time.time()
+            pos = sent % len(video)
+            packet = video[pos:pos + size]
+            for peer, last in self.video_peers.items():
+                if now - last < 3:
+                    try:
+                        self.live.sendto(packet, peer)
+                    except socket.error:
+                        pass
+            sent += len(packet)
+            time.sleep(max(0, start + 8. * sent / self.video_bitrate -
+                           time.time()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to serve on. Default is 127.0.0.1.')
+    parser.add_argument('--http-port', type=int, default=8080,
+                        help='Port for the REST API. Default is 8080.')
+    parser.add_argument('--live-port', type=int, default=49152,
+                        help='Port for the live streams. Default is 49152.')
+    parser.add_argument('--video', default=None,
+                        help='MPEG-TS file to stream as the live video')
+    args = parser.parse_args()
+
+    glasses = MockGlasses(args.host, args.http_port, args.live_port,
+                          video=args.video)
+    glasses.start()
+    print "Mock glasses at %s (REST port %i, live port %i)" % (
+        glasses.host, glasses.http_port, glasses.live_port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        glasses.stop()
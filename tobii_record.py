@@ -5,16 +5,19 @@
     Based on Tobii SDK
 '''
 
+import argparse
+import httplib
 import threading
-import urllib2
 import json
 import time
 import socket
 import sys
+import traceback
+from tobii_data_process import RecordCollector, add_seconds, output_base, \
+    write_data, OUTPUT_FORMATS
 
 GLASSES_IP = "192.168.71.50"  # IPv4 address
 PORT = 49152
-base_url = 'http://' + GLASSES_IP
 timeout = 1
 
 # Keep-alive message content used to request live data and live video streams
@@ -29,113 +32,346 @@ def mksock(peer):
     return socket.socket(iptype, socket.SOCK_DGRAM)
 
 
-# Callback function
-def send_keepalive_msg(socket, msg, peer):
-    while True:
-        socket.sendto(msg, peer)
-        time.sleep(timeout)
-
-
-def post_request(api_action, data=None):
-    url = base_url + api_action
-    req = urllib2.Request(url)
-    req.add_header('Content-Type', 'application/json')
-    data = json.dumps(data)
-    response = urllib2.urlopen(req, data)
-    data = response.read()
-    json_data = json.loads(data)
-    return json_data
-
-
-def get_request(api_action):
-    url = base_url + api_action
-    req = urllib2.Request(url)
-    req.add_header('Content-Type', 'application/json')
-    response = urllib2.urlopen(req)
-    data = response.read()
-    json_data = json.loads(data)
-    return json_data
-
-
-def wait_for_status(api_action, key, values):
-    url = base_url + api_action
-    running = True
-    while running:
-        req = urllib2.Request(url)
-        req.add_header('Content-Type', 'application/json')
-        response = urllib2.urlopen(req, None)
-        data = response.read()
-        json_data = json.loads(data)
-        if json_data[key] in values:
-            running = False
-        time.sleep(1)
-
-    return json_data[key]
-
-
-def create_project():
-    json_data = post_request('/api/projects')
-    return json_data['pr_id']
-
-
-def create_participant(project_id):
-    data = {'pa_project': project_id}
-    json_data = post_request('/api/participants', data)
-    return json_data['pa_id']
-
-
-def create_calibration(project_id, participant_id):
-    data = {'ca_project': project_id, 'ca_type': 'default',
-            'ca_participant': participant_id}
-    json_data = post_request('/api/calibrations', data)
-    return json_data['ca_id']
-
-
-def start_calibration(calibration_id):
-    post_request('/api/calibrations/' + calibration_id + '/start')
-
-
-def create_recording(participant_id):
-    data = {'rec_participant': participant_id}
-    json_data = post_request('/api/recordings', data)
-    return json_data['rec_id']
-
-
-def start_recording(recording_id):
-    post_request('/api/recordings/' + recording_id + '/start')
-
-
-def stop_recording(recording_id):
-    post_request('/api/recordings/' + recording_id + '/stop')
+class RingBuffer(object):
+    """
+    Fixed size buffer of the latest items from a single writer thread.  The
+    writer never waits on readers: each append overwrites the oldest item
+    and bumps a counter, and readers copy out what they need by count.
+    """
+    def __init__(self, capacity=4096):
+        self.items = [None] * capacity
+        self.count = 0
+
+    def append(self, item):
+        self.items[self.count % len(self.items)] = item
+        self.count += 1
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.items[(self.count - 1) % len(self.items)]
+
+    def since(self, count):
+        """
+        Returns the items appended since the counter was at `count`, oldest
+        first, along with the counter to pass next time.  Items that were
+        overwritten before they could be read are skipped.
+        """
+        end = self.count
+        start = max(count, end - len(self.items))
+        items = [self.items[i % len(self.items)] for i in range(start, end)]
+        # drop any the writer overwrote while they were being copied, along
+        # with the slot it may be writing now (counted only once written)
+        lost = self.count + 1 - len(self.items) - start
+        if lost > 0:
+            items = items[lost:]
+        return items, end
+
+
+class LiveDataReceiver(object):
+    """
+    Receives the live data the glasses stream back to the socket that keeps
+    it alive (see KA_DATA_MSG).  A background thread parses each JSON
+    datagram as it arrives, stamps it with its arrival time (time.time()),
+    keeps the latest `capacity` (arrival time, entry) pairs for latest() and
+    since() to read, and passes the same to every subscriber.
+
+    If `out_path` (a .json file) is given, it is overwritten with the
+    datagrams as they arrive, in the JSON lines format tobii_data_process
+    reads, and when stopped the session is written next to it in
+    read_data's columnar layout, as process would convert it.
+    """
+    def __init__(self, sock, out_path=None, out_format='csv', capacity=4096):
+        self.sock = sock
+        self.buffer = RingBuffer(capacity)
+        self.subscribers = []
+        self.out_path = out_path
+        self.out_format = out_format
+        self.collector = RecordCollector()
+        self.lock = threading.Lock()
+        self.bad_packets = 0
+        self.subscriber_errors = 0
+        self.running = False
+        self.thread = None
+
+    def subscribe(self, callback):
+        """
+        Calls callback(arrival time, entry) for every entry from now on.  It
+        runs on the receiver thread, so it should return quickly.  Exceptions
+        it raises are counted in `subscriber_errors` (the first is printed)
+        and don't stop the receiver.
+        """
+        # replaced rather than changed, so the receiver never sees it mid-edit
+        self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [s for s in self.subscribers if s is not callback]
+
+    def latest(self):
+        """
+        The newest (arrival time, entry), or None if nothing has arrived.
+        """
+        return self.buffer.latest()
+
+    def since(self, count=0):
+        """
+        Returns the (arrival time, entry) pairs received since the receiver's
+        count was at `count`, oldest first, and the count to pass next time,
+        so a reader can poll for new data without subscribing.  Entries
+        pushed out of the buffer before they were read are skipped.
+        """
+        return self.buffer.since(count)
+
+    def frame(self):
+        """
+        The data received so far, as read_data would give it.
+        """
+        with self.lock:
+            return self.collector.frame()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        if self.subscriber_errors:
+            print '%i live data subscriber calls failed' % self.subscriber_errors
+        if self.out_path is not None and self.collector.buffers:
+            base = output_base(self.out_path)
+            write_data(add_seconds(self.frame()),
+                       base + OUTPUT_FORMATS[self.out_format], self.out_format)
+            if self.collector.pulse_sync:
+                with open(base + '_sync_pulses.json', 'w') as f:
+                    json.dump(self.collector.pulse_sync, f)
+
+    def _receive(self):
+        # wake up regularly to check whether to stop
+        self.sock.settimeout(0.1)
+        out = None
+        if self.out_path is not None:
+            out = open(self.out_path, 'w')
+        try:
+            while self.running:
+                try:
+                    data = self.sock.recv(65536)
+                except socket.timeout:
+                    continue
+                now = time.time()
+                try:
+                    entry = json.loads(data)
+                    with self.lock:
+                        self.collector.add(entry)
+                except (ValueError, KeyError, TypeError):
+                    self.bad_packets += 1
+                    continue
+                self.buffer.append((now, entry))
+                for callback in self.subscribers:
+                    try:
+                        callback(now, entry)
+                    except Exception:
+                        self.subscriber_errors += 1
+                        # a broken subscriber likely fails on every entry
+                        if self.subscriber_errors == 1:
+                            traceback.print_exc()
+                if out is not None:
+                    out.write(data.strip() + '\n')
+        finally:
+            if out is not None:
+                out.close()
+
+
+class KeepAlive(object):
+    """
+    Sends the keep-alive messages for any number of live streams, on any
+    number of glasses, from a single thread: every `interval` seconds each
+    stream's message is sent to its peer.
+    """
+    def __init__(self, interval=timeout):
+        self.interval = interval
+        self.streams = []
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, sock, msg, peer):
+        self.streams = self.streams + [(sock, msg, peer)]
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            for sock, msg, peer in self.streams:
+                sock.sendto(msg, peer)
+            self.stopped.wait(self.interval)
+
+
+class GlassesClient(object):
+    """
+    Drives one pair of glasses through its REST API over a single persistent
+    HTTP connection, which is reopened if the glasses drop it.  Status is
+    polled every `poll_interval` seconds.  Clients are independent, so one
+    process can drive several pairs of glasses.
+    """
+    def __init__(self, ip=GLASSES_IP, http_port=80, live_port=PORT,
+                 poll_interval=0.1, request_timeout=5):
+        self.ip = ip
+        self.peer = (ip, live_port)
+        self.poll_interval = poll_interval
+        self.conn = httplib.HTTPConnection(ip, http_port,
+                                           timeout=request_timeout)
+
+    def request(self, method, api_action, data=None):
+        headers = {'Content-Type': 'application/json'}
+        body = json.dumps(data) if method == 'POST' else None
+        for attempt in range(2):
+            # the glasses may have closed an idle connection since it was
+            # last used, which only shows once it's used again
+            reused = self.conn.sock is not None
+            sent = False
+            try:
+                self.conn.request(method, api_action, body, headers)
+                sent = True
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                self.conn.close()
+                # retry once on a new connection, but only if the request
+                # can't have been acted on: it failed to send, or the
+                # connection closed without a response.  Anything else (a
+                # timeout waiting for the response, say) is raised, since
+                # the glasses may already have started a recording.
+                unanswered = (not sent or
+                              isinstance(e, httplib.BadStatusLine))
+                if attempt > 0 or not reused or not unanswered:
+                    raise
+        if response.status >= 400:
+            raise Exception('%s %s failed: %i %s' % (
+                method, api_action, response.status, response.reason))
+        return json.loads(data)
+
+    def post_request(self, api_action, data=None):
+        return self.request('POST', api_action, data)
+
+    def get_request(self, api_action):
+        return self.request('GET', api_action)
+
+    def wait_for_status(self, api_action, key, values):
+        while True:
+            json_data = self.get_request(api_action)
+            if json_data[key] in values:
+                return json_data[key]
+            time.sleep(self.poll_interval)
+
+    def create_project(self):
+        return self.post_request('/api/projects')['pr_id']
+
+    def create_participant(self, project_id):
+        data = {'pa_project': project_id}
+        return self.post_request('/api/participants', data)['pa_id']
+
+    def create_calibration(self, project_id, participant_id):
+        data = {'ca_project': project_id, 'ca_type': 'default',
+                'ca_participant': participant_id}
+        return self.post_request('/api/calibrations', data)['ca_id']
+
+    def start_calibration(self, calibration_id):
+        self.post_request('/api/calibrations/' + calibration_id + '/start')
+
+    def wait_for_calibration(self, calibration_id):
+        return self.wait_for_status(
+            '/api/calibrations/' + calibration_id + '/status', 'ca_state',
+            ['failed', 'calibrated'])
+
+    def create_recording(self, participant_id):
+        data = {'rec_participant': participant_id}
+        return self.post_request('/api/recordings', data)['rec_id']
+
+    def start_recording(self, recording_id):
+        self.post_request('/api/recordings/' + recording_id + '/start')
+
+    def stop_recording(self, recording_id):
+        self.post_request('/api/recordings/' + recording_id + '/stop')
+
+    def wait_for_recording(self, recording_id):
+        return self.wait_for_status(
+            '/api/recordings/' + recording_id + '/status', 'rec_state',
+            ['failed', 'done'])
+
+    def live_sockets(self, keepalive):
+        """
+        Opens the live data and live video sockets and adds them to a
+        KeepAlive.  Returns (data socket, video socket).
+        """
+        data_socket = mksock(self.peer)
+        keepalive.add(data_socket, KA_DATA_MSG, self.peer)
+        video_socket = mksock(self.peer)
+        keepalive.add(video_socket, KA_VIDEO_MSG, self.peer)
+        return data_socket, video_socket
+
+    def close(self):
+        self.conn.close()
 
 
 if __name__ == "__main__":
-    peer = (GLASSES_IP, PORT)
-
-    # Create socket which will send a keep alive message for the live data stream
-    data_socket = mksock(peer)
-    td = threading.Thread(target=send_keepalive_msg, args=[data_socket, KA_DATA_MSG, peer])
-    td.daemon = True
-    td.start()
-
-    # Create socket which will send a keep alive message for the live video stream
-    video_socket = mksock(peer)
-    tv = threading.Thread(target=send_keepalive_msg, args=[video_socket, KA_VIDEO_MSG, peer])
-    tv.daemon = True
-    tv.start()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--live-data', default=None,
+        help='Save the live gaze data streamed during the session to this ' +
+             '.json file, plus a converted copy alongside it.')
+    parser.add_argument(
+        '--format', choices=sorted(OUTPUT_FORMATS), default='csv',
+        help='Output format for the converted live data. Default is csv.')
+    parser.add_argument(
+        '--ip', default=GLASSES_IP,
+        help='IP address of the glasses. Default is %s.' % GLASSES_IP)
+    parser.add_argument(
+        '--http-port', type=int, default=80,
+        help='Port of the glasses REST API. Default is 80.')
+    parser.add_argument(
+        '--live-port', type=int, default=PORT,
+        help='Port of the glasses live streams. Default is %i.' % PORT)
+    parser.add_argument(
+        '--poll-interval', type=float, default=0.1,
+        help='Seconds between calibration and recording status checks. ' +
+             'Default is 0.1.')
+    args = parser.parse_args()
+
+    glasses = GlassesClient(args.ip, args.http_port, args.live_port,
+                            poll_interval=args.poll_interval)
+
+    # keep the live data and live video streams alive
+    keepalive = KeepAlive()
+    data_socket, video_socket = glasses.live_sockets(keepalive)
+    keepalive.start()
+
+    receiver = None
+    if args.live_data is not None:
+        receiver = LiveDataReceiver(data_socket, args.live_data,
+                                    out_format=args.format)
+        receiver.start()
 
     try:
-        project_id = create_project()
-        participant_id = create_participant(project_id)
-        calibration_id = create_calibration(project_id, participant_id)
+        project_id = glasses.create_project()
+        participant_id = glasses.create_participant(project_id)
+        calibration_id = glasses.create_calibration(project_id, participant_id)
 
         print "Project: " + project_id, ", Participant: ", participant_id, ", Calibration: ", calibration_id, " "
 
         input_var = raw_input("Press enter to calibrate")
         print ('Calibration started...')
-        start_calibration(calibration_id)
-        status = wait_for_status(
-            '/api/calibrations/' + calibration_id + '/status', 'ca_state', ['failed', 'calibrated'])
+        glasses.start_calibration(calibration_id)
+        status = glasses.wait_for_calibration(calibration_id)
 
         if status == 'failed':
             print ('Calibration failed, quitting')
@@ -143,16 +379,20 @@ if __name__ == "__main__":
         else:
             print ('Calibration successful')
 
-        recording_id = create_recording(participant_id)
+        recording_id = glasses.create_recording(participant_id)
         print ('Recording started...')
-        start_recording(recording_id)
+        glasses.start_recording(recording_id)
         raw_input("Press enter to stop recording")
-        stop_recording(recording_id)
-        status = wait_for_status('/api/recordings/' + recording_id + '/status',
-                                 'rec_state', ['failed', 'done'])
+        glasses.stop_recording(recording_id)
+        status = glasses.wait_for_recording(recording_id)
         if status == 'failed':
             print ('Recording failed')
         else:
             print ('Recording successful')
     except:
         raise
+    finally:
+        if receiver is not None:
+            receiver.stop()
+        keepalive.stop()
+        glasses.close()
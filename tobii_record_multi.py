@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''
+    Records on several pairs of Tobii Glasses 2 at once.  Every pair is
+    calibrated concurrently, and recordings are started (and stopped) on
+    all of them as close to simultaneously as possible, with the skew
+    between devices logged.
+
+    Glasses are given as IP[:REST port[:live port]].  With --mock N, N stand-in
+    glasses (see tobii_mock_glasses) are run locally instead.
+'''
+import argparse
+import json
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from tobii_record import GlassesClient, KeepAlive, PORT
+from tobii_mock_glasses import MockGlasses
+
+# how long before a synchronized request to stop sleeping and start spinning
+SPIN_TIME = 0.005
+
+
+def parse_glasses(spec):
+    parts = spec.split(':')
+    http_port = int(parts[1]) if len(parts) > 1 else 80
+    live_port = int(parts[2]) if len(parts) > 2 else PORT
+    return parts[0], http_port, live_port
+
+
+class Orchestrator(object):
+    """
+    Drives a GlassesClient per device, one thread each.  `lead` is how far
+    ahead (seconds) synchronized requests are scheduled once every device's
+    thread is ready, which gives slow threads time to get to the start line.
+    """
+    def __init__(self, clients, lead=0.2):
+        self.clients = clients
+        self.lead = lead
+        self.pool = ThreadPool(len(clients))
+        self.projects = [None] * len(clients)
+        self.participants = [None] * len(clients)
+        self.calibrations = [None] * len(clients)
+        self.recordings = [None] * len(clients)
+        self.recording = [False] * len(clients)
+
+    def _map(self, func):
+        # the pool's own map raises as soon as one call fails, with the rest
+        # still running, so errors are only raised once every call is done
+        def call(i):
+            try:
+                return func(i), None
+            except Exception:
+                return None, sys.exc_info()
+        results = self.pool.map(call, range(len(self.clients)))
+        for result, error in results:
+            if error is not None:
+                raise error[0], error[1], error[2]
+        return [result for result, error in results]
+
+    def setup(self):
+        def setup_one(i):
+            client = self.clients[i]
+            self.projects[i] = client.create_project()
+            self.participants[i] = client.create_participant(self.projects[i])
+            self.calibrations[i] = client.create_calibration(
+                self.projects[i], self.participants[i])
+        self._map(setup_one)
+
+    def calibrate(self):
+        """
+        Calibrates every device, returning each one's final state.
+        """
+        def calibrate_one(i):
+            self.clients[i].start_calibration(self.calibrations[i])
+            return self.clients[i].wait_for_calibration(self.calibrations[i])
+        return self._map(calibrate_one)
+
+    def synchronized(self, request):
+        """
+        Calls request(i) for every device at the same scheduled moment.
+        Returns the scheduled time and, for each device, the times the
+        request was sent and answered.
+        """
+        go = time.time() + self.lead
+
+        def fire(i):
+            time.sleep(max(0, go - SPIN_TIME - time.time()))
+            while time.time() < go:
+                pass
+            sent = time.time()
+            request(i)
+            return sent, time.time()
+        return go, self._map(fire)
+
+    def start_recording(self):
+        def create_one(i):
+            self.recordings[i] = self.clients[i].create_recording(
+                self.participants[i])
+        self._map(create_one)
+
+        def start_one(i):
+            # marked first: a start that fails may still have reached it
+            self.recording[i] = True
+            self.clients[i].start_recording(self.recordings[i])
+        return self.synchronized(start_one)
+
+    def stop_recording(self):
+        def stop_one(i):
+            self.clients[i].stop_recording(self.recordings[i])
+            self.recording[i] = False
+        timing = self.synchronized(stop_one)
+        states = self._map(
+            lambda i: self.clients[i].wait_for_recording(self.recordings[i]))
+        return timing, states
+
+    def abort(self):
+        """
+        Stops any recordings still going, such as those that did start when
+        starting failed on another device, one device at a time so that a
+        failure on one doesn't leave the rest recording.  Returns the
+        devices stopped.
+        """
+        stopped = []
+        for i, recording in enumerate(self.recording):
+            if not recording:
+                continue
+            try:
+                self.clients[i].stop_recording(self.recordings[i])
+                stopped.append(i)
+            except Exception as e:
+                print 'Unable to stop recording on device %i: %s' % (i, e)
+            self.recording[i] = False
+        return stopped
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for client in self.clients:
+            client.close()
+
+
+def log_skew(name, go, times, log=None):
+    """
+    Prints when each device received a synchronized request, estimated as
+    the midpoint of sending it and getting the answer, and the skew between
+    the earliest and latest.  Appends the same as a JSON line to `log`.
+    """
+    mids = [(sent + acked) / 2. for sent, acked in times]
+    skew = max(mids) - min(mids)
+    print "%s skew: %.2f ms" % (name, 1000 * skew)
+    for i, (sent, acked) in enumerate(times):
+        print "  device %i: sent %+.2f ms, round trip %.2f ms" % (
+            i, 1000 * (sent - go), 1000 * (acked - sent))
+    if log is not None:
+        log.write(json.dumps({'event': name, 'scheduled': go,
+                              'sent': [t[0] for t in times],
+                              'acked': [t[1] for t in times],
+                              'skew': skew}) + '\n')
+        log.flush()
+    return skew
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'glasses', nargs='*',
+        help='Glasses to record on, as IP[:REST port[:live port]]')
+    parser.add_argument(
+        '--mock', type=int, default=0,
+        help='Record on this many local stand-in glasses instead.')
+    parser.add_argument(
+        '--poll-interval', type=float, default=0.1,
+        help='Seconds between calibration and recording status checks. ' +
+             'Default is 0.1.')
+    parser.add_argument(
+        '--log', default=None,
+        help='Append start and stop timings to this file as JSON lines.')
+    args = parser.parse_args()
+
+    mocks = [MockGlasses() for i in range(args.mock)]
+    for mock in mocks:
+        mock.start()
+    specs = ([parse_glasses(g) for g in args.glasses] +
+             [(m.host, m.http_port, m.live_port) for m in mocks])
+    if not specs:
+        parser.error('no glasses given')
+
+    clients = [GlassesClient(ip, http_port, live_port,
+                             poll_interval=args.poll_interval)
+               for ip, http_port, live_port in specs]
+    keepalive = KeepAlive()
+    for client in clients:
+        client.live_sockets(keepalive)
+    keepalive.start()
+    orchestrator = Orchestrator(clients)
+    log = open(args.log, 'a') if args.log is not None else None
+
+    try:
+        orchestrator.setup()
+        for i, spec in enumerate(specs):
+            print "Device %i (%s): Project: %s, Participant: %s, Calibration: %s" % (
+                i, spec[0], orchestrator.projects[i],
+                orchestrator.participants[i], orchestrator.calibrations[i])
+
+        raw_input("Press enter to calibrate all glasses")
+        print 'Calibration started...'
+        states = orchestrator.calibrate()
+        failed = [i for i, state in enumerate(states) if state == 'failed']
+        if failed:
+            print 'Calibration failed on device(s) %s, quitting' % (
+                ', '.join(str(i) for i in failed))
+            sys.exit()
+        print 'Calibration successful'
+
+        go, times = orchestrator.start_recording()
+        print 'Recording started...'
+        log_skew('start', go, times, log)
+        raw_input("Press enter to stop recording")
+        (go, times), states = orchestrator.stop_recording()
+        log_skew('stop', go, times, log)
+        for i, state in enumerate(states):
+            print 'Device %i: recording %s' % (
+                i, 'failed' if state == 'failed' else 'successful')
+    finally:
+        stopped = orchestrator.abort()
+        if stopped:
+            print 'Stopped recording on device(s) %s' % (
+                ', '.join(str(i) for i in stopped))
+        keepalive.stop()
+        orchestrator.close()
+        if log is not None:
+            log.close()
+        for mock in mocks:
+            mock.stop()
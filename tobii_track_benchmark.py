@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Benchmarks object tracking on a scene camera video.  The tracker runs once
+with full resolution feature matching on every frame as a baseline, then once
+for each keyframe interval, pyramid level and region of interest margin
+given, and reports the speed of each mode along with how far its match image
+outlines drift from the baseline's.
+"""
+import argparse
+import cv2
+import numpy as np
+import time
+from tobii_track_object import ObjectTracker, StageTimer, homography_table
+
+
+def outline_error(table, baseline, sizes):
+    """
+    Distance (frame pixels) between the corners of each match image as
+    placed by two homography tables, over the frames where both found it.
+    """
+    errors = []
+    for i, (w, h) in enumerate(sizes):
+        both = ~np.isnan(table[:, i, 0, 0]) & ~np.isnan(baseline[:, i, 0, 0])
+        if not both.any():
+            continue
+        corners = np.array([[0, 0, 1], [w, 0, 1], [w, h, 1], [0, h, 1]], float).T
+        placed = []
+        for t in (table, baseline):
+            # homographies map frame to still, so invert to place the still
+            pts = np.dot(np.linalg.inv(t[both, i]), corners)
+            placed.append(pts[:, :2] / pts[:, 2:])
+        errors.append(np.sqrt(((placed[0] - placed[1]) ** 2).sum(1)).ravel())
+    if len(errors) == 0:
+        return np.array([np.nan])
+    return np.concatenate(errors)
+
+
+def run(vid_path, match_imgs, max_frames=None, **tracker_args):
+    timer = StageTimer()
+    tracker = ObjectTracker(match_imgs, 50, timer=timer, **tracker_args)
+    start = time.time()
+    times, table = homography_table(vid_path, tracker, stop=max_frames,
+                                    verbose=False)
+    return table, time.time() - start, timer
+
+
+def benchmark(vid_path, match_paths, intervals=(), levels=(), margins=(),
+              max_frames=None):
+    match_imgs = [cv2.cvtColor(cv2.imread(m), cv2.COLOR_BGR2GRAY)
+                  for m in match_paths]
+    sizes = [(img.shape[1], img.shape[0]) for img in match_imgs]
+
+    print "Running every-frame baseline..."
+    baseline, base_time, timer = run(vid_path, match_imgs, max_frames)
+    frames = len(baseline)
+    timer.report(frames)
+    rows = [('every frame', base_time, baseline, np.zeros(1))]
+
+    modes = ([('keyframe %i' % k, dict(keyframe_interval=k))
+              for k in intervals] +
+             [('pyramid %i' % p, dict(pyramid_level=p)) for p in levels] +
+             [('roi %.2f' % r, dict(roi_margin=r)) for r in margins])
+    for name, tracker_args in modes:
+        print "Running %s..." % name
+        table, took, timer = run(vid_path, match_imgs, max_frames,
+                                 **tracker_args)
+        timer.report(frames)
+        rows.append((name, took, table,
+                     outline_error(table, baseline, sizes)))
+
+    print
+    print '%-14s %10s %8s %8s %10s %10s' % ('mode', 'ms/frame', 'speedup',
+                                            'found', 'mean err', 'max err')
+    for name, took, table, err in rows:
+        found = np.mean(~np.isnan(table[:, :, 0, 0]))
+        print '%-14s %10.1f %7.1fx %7.1f%% %9.2fpx %9.2fpx' % (
+            name, 1000. * took / max(frames, 1), base_time / took,
+            100 * found, np.nanmean(err), np.nanmax(err))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'video', help='Tobii scene camera video')
+    parser.add_argument(
+        '-m', '--match', nargs='+',
+        help='REQUIRED: Image(s) to find in the video', required=True)
+    parser.add_argument(
+        '-k', '--keyframe-intervals', nargs='+', type=int, default=[5, 10],
+        help='Keyframe intervals to compare against the baseline.')
+    parser.add_argument(
+        '-p', '--pyramid-levels', nargs='+', type=int, default=[1],
+        help='Pyramid levels to compare against the baseline.')
+    parser.add_argument(
+        '-r', '--roi-margins', nargs='+', type=float, default=[0.5],
+        help='Region of interest margins to compare against the baseline.')
+    parser.add_argument(
+        '-n', '--frames', type=int, default=None,
+        help='Only benchmark the first this many frames.')
+    args = parser.parse_args()
+
+    benchmark(args.video, args.match, args.keyframe_intervals,
+              args.pyramid_levels, args.roi_margins, args.frames)
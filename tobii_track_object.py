@@ -4,67 +4,455 @@ This script will track gaze points over a static image, based on gaze data and
 scene camera video from a glasses recording.
 """
 import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
 import cv2
+import hashlib
+import json
+import multiprocessing
 import numpy as np
-import pandas as pd
 import sys
 import os
+import time
+import zipfile
+from tobii_data_process import load_data, align_frames, frame_samples, \
+    file_stamp, GAZE_POS_COLUMNS
+from tobii_video import open_writer, TraceRenderer, WRITERS
 
 OPENCV3 = (cv2.__version__.split('.')[0] == '3')
 
 
-def object_find(match_sift, frame, MIN_MATCH_COUNT):
+def create_sift():
+    if OPENCV3:
+        return cv2.xfeatures2d.SIFT_create()
+    else:
+        return cv2.SIFT()
+
+
+class StageTimer(object):
+    """
+    Accumulates the wall time spent in each named stage of processing.
+    """
+    def __init__(self):
+        self.totals = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.totals[name] = (self.totals.get(name, 0.) +
+                                 time.time() - start)
+
+    def report(self, frames):
+        print "Time per frame by stage (ms):"
+        for name, total in self.totals.items():
+            print '  %-12s %8.2f' % (name, 1000. * total / max(frames, 1))
+
+
+class ObjectTracker(object):
     '''
-    Finds an object (from precomputed sift features) within a frame.  If
-    found it returns the transformation matrix from frame to still.
+    Finds match images within video frames using SIFT feature matching.  The
+    SIFT detector is created once, and each match image gets its own FLANN
+    matcher whose index over the image's descriptors is trained up front and
+    reused for every frame.  Each frame's features are detected once and
+    matched against every match image.
+
+    When following a video with `track`, full matching only runs on every
+    `keyframe_interval`th frame.  In between, the inlier points of each found
+    match image are followed with sparse optical flow and its homography is
+    refit to them.  If fewer than `min_track_ratio` of a match image's
+    keyframe inliers (or fewer than `min_track_points`) survive, full
+    matching runs again on that frame.  Match images that are lost stay lost
+    until the next keyframe.  A keyframe_interval of 1 matches every frame.
+
+    To speed up feature detection, frames can be searched at a downscaled
+    `pyramid_level` (each level halves the resolution), with keypoints mapped
+    back to full resolution.  When all match images were found in the
+    previous frame and `roi_margin` is set, `track` only searches the region
+    around them, padded by roi_margin times the region's size, and falls
+    back to the whole frame if any of them is missing from the region.
 
     This code is based on the OpenCV feature detection tutorial
     '''
+    FLANN_INDEX_KDTREE = 0
+
+    def __init__(self, match_imgs, min_match_count=50, ratio=0.7,
+                 timer=None, keyframe_interval=1, min_track_ratio=0.5,
+                 min_track_points=10, pyramid_level=0, roi_margin=None):
+        self.sift = create_sift()
+        self.timer = timer if timer is not None else StageTimer()
+        self.min_match_count = min_match_count
+        self.ratio = ratio
+        self.keyframe_interval = keyframe_interval
+        self.min_track_ratio = min_track_ratio
+        self.min_track_points = min_track_points
+        self.pyramid_level = pyramid_level
+        self.roi_margin = roi_margin
+        self.refs = []
+        for img in match_imgs:
+            kp, des = self.sift.detectAndCompute(img, None)
+            if des is not None and len(kp) >= 2:
+                matcher = cv2.FlannBasedMatcher(
+                    dict(algorithm=self.FLANN_INDEX_KDTREE, trees=5),
+                    dict(checks=50))
+                matcher.add([des])
+                matcher.train()
+            else:
+                matcher = None
+            self.refs.append((kp, matcher, (img.shape[1], img.shape[0])))
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets the previous frame, so the next call to track is a keyframe.
+        '''
+        self.prev_frame = None
+        self.since_keyframe = 0
+        # per match image: (frame points, match image points, keyframe count)
+        self.tracks = [None] * len(self.refs)
+        self.last_Ms = [None] * len(self.refs)
+
+    def find_all(self, frame):
+        '''
+        Finds every match image within a grayscale frame, returning a list
+        of transformation matrices from frame to still (None where not found).
+        '''
+        return [M for M, pts in self._find_all(frame)]
+
+    def features(self, frame, roi=None):
+        '''
+        Detects SIFT features in a grayscale frame, or in its (x0, y0, x1, y1)
+        region of interest, at the tracker's pyramid level.  Returns the
+        keypoint locations in full resolution frame pixels and descriptors.
+        '''
+        x0, y0 = 0, 0
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            frame = frame[y0:y1, x0:x1]
+        for level in range(self.pyramid_level):
+            frame = cv2.pyrDown(frame)
+        kp, des = self.sift.detectAndCompute(frame, None)
+        scale = 2 ** self.pyramid_level
+        pts = (np.float32([k.pt for k in kp]).reshape(-1, 2) + 0.5) * scale - 0.5
+        return pts + np.float32([x0, y0]), des
+
+    def find(self, index, features):
+        '''
+        Finds match image `index` given a frame's features (see features).
+        If found it returns the transformation matrix from frame to still.
+        '''
+        return self._match(index, features)[0]
+
+    def track(self, frame):
+        '''
+        Like find_all, for the next grayscale frame of a video.  Between
+        keyframes the matrices are propagated with optical flow.
+        '''
+        Ms = None
+        if (self.prev_frame is not None and
+                self.since_keyframe < self.keyframe_interval - 1):
+            Ms = self._propagate(frame)
+        if Ms is None:
+            roi = self._roi(frame.shape)
+            found = self._find_all(frame, roi)
+            if roi is not None and any(M is None for M, pts in found):
+                # lost one of them, so search the whole frame
+                found = self._find_all(frame)
+            Ms = [M for M, pts in found]
+            self.tracks = [(pts[0], pts[1], len(pts[0]))
+                           if pts is not None else None
+                           for M, pts in found]
+            self.since_keyframe = 0
+        else:
+            self.since_keyframe += 1
+        self.prev_frame = frame
+        self.last_Ms = Ms
+        return Ms
+
+    def _find_all(self, frame, roi=None):
+        with self.timer.stage('detect'):
+            features = self.features(frame, roi)
+        return [self._match(i, features) for i in range(len(self.refs))]
+
+    def _roi(self, shape):
+        # bounding box of every match image's last location, padded by
+        # roi_margin; None to search the whole frame
+        if self.roi_margin is None or any(M is None for M in self.last_Ms):
+            return None
+        corners = []
+        for M, (kp, matcher, (w, h)) in zip(self.last_Ms, self.refs):
+            try:
+                # homographies map frame to still, so invert to place the still
+                pts = np.dot(np.linalg.inv(M),
+                             np.array([[0, w, w, 0], [0, 0, h, h], [1, 1, 1, 1]], float))
+            except np.linalg.LinAlgError:
+                return None
+            if (pts[2] <= 0).any():
+                return None
+            corners.append(pts[:2] / pts[2])
+        corners = np.concatenate(corners, axis=1)
+        (x0, y0), (x1, y1) = corners.min(1), corners.max(1)
+        pad_x, pad_y = self.roi_margin * (x1 - x0), self.roi_margin * (y1 - y0)
+        x0, y0 = int(max(x0 - pad_x, 0)), int(max(y0 - pad_y, 0))
+        x1, y1 = int(min(x1 + pad_x, shape[1])), int(min(y1 + pad_y, shape[0]))
+        if x1 - x0 < 16 or y1 - y0 < 16:
+            return None
+        return x0, y0, x1, y1
+
+    def _match(self, index, features):
+        # returns the homography and its (frame, match image) inlier points
+        kp1, matcher, size = self.refs[index]
+        pts2, des2 = features
+        if matcher is None or des2 is None or len(pts2) < 2:
+            return None, None
+
+        with self.timer.stage('match'):
+            # frame descriptors are the queries, match image ones the train set
+            matches = matcher.knnMatch(des2, k=2)
+            good = [pair[0] for pair in matches
+                    if len(pair) == 2 and
+                    pair[0].distance < self.ratio * pair[1].distance]
+
+        if len(good) > self.min_match_count:
+            with self.timer.stage('homography'):
+                src_pts = pts2[[m.queryIdx for m in good]].reshape(-1, 1, 2)
+                dst_pts = np.float32([kp1[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+
+                M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+
+            if M is None:
+                return None, None
+            inliers = mask.ravel() == 1
+            return M, (src_pts[inliers], dst_pts[inliers])
+
+        else:
+            return None, None
+
+    def _propagate(self, frame):
+        # follows every tracked match image's inliers into `frame`; returns
+        # None when one of them has lost too many points to trust
+        tracked = [i for i, t in enumerate(self.tracks) if t is not None]
+        Ms = [None] * len(self.refs)
+        if len(tracked) == 0:
+            return Ms
+
+        with self.timer.stage('flow'):
+            prev_pts = np.concatenate([self.tracks[i][0] for i in tracked])
+            lk_params = dict(winSize=(21, 21), maxLevel=3)
+            next_pts, status, err = cv2.calcOpticalFlowPyrLK(
+                self.prev_frame, frame, prev_pts, None, **lk_params)
+            # keep points that flow back to where they started
+            back_pts, back_status, err = cv2.calcOpticalFlowPyrLK(
+                frame, self.prev_frame, next_pts, None, **lk_params)
+            good = ((status.ravel() == 1) & (back_status.ravel() == 1) &
+                    (np.absolute(prev_pts - back_pts).reshape(-1, 2).max(1) < 1))
+
+        start = 0
+        for i in tracked:
+            frame_pts, ref_pts, n_key = self.tracks[i]
+            stop = start + len(frame_pts)
+            ok = good[start:stop]
+            moved, ref_pts = next_pts[start:stop][ok], ref_pts[ok]
+            start = stop
+            if (len(moved) < max(self.min_track_points, 4) or
+                    len(moved) < self.min_track_ratio * n_key):
+                return None
+            with self.timer.stage('homography'):
+                M, mask = cv2.findHomography(moved, ref_pts, cv2.RANSAC, 5.0)
+            if M is None:
+                return None
+            inliers = mask.ravel() == 1
+            if inliers.sum() < self.min_track_ratio * n_key:
+                return None
+            Ms[i] = M
+            self.tracks[i] = (moved[inliers], ref_pts[inliers], n_key)
+        return Ms
+
+
+def homography_table(vid_path, tracker, start=0, stop=None, verbose=True):
+    """
+    Runs a tracker over frames [start, stop) of a video (all of them by
+    default).  Returns the video time (ms) as each frame is read, and an
+    array of shape (frames, match images, 3, 3) of frame to still
+    transformations, NaN where a match image wasn't found.
+    """
+    vid = cv2.VideoCapture(vid_path)
     if OPENCV3:
-        sift = cv2.xfeatures2d.SIFT_create()
+        tot = vid.get(cv2.CAP_PROP_FRAME_COUNT)
+        if start > 0:
+            vid.set(cv2.CAP_PROP_POS_FRAMES, start)
     else:
-        sift = cv2.SIFT()
-    kp1, des1 = match_sift
-    kp2, des2 = sift.detectAndCompute(frame, None)
+        tot = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
+        if start > 0:
+            vid.set(cv2.cv.CV_CAP_PROP_POS_FRAMES, start)
+    if stop is not None:
+        tot = min(tot, stop)
+    tot -= start
+    tracker.reset()
+    times = []
+    table = []
+    while vid.isOpened() and (stop is None or start + len(table) < stop):
+        if OPENCV3:
+            vid_time = vid.get(cv2.CAP_PROP_POS_MSEC)
+        else:
+            vid_time = vid.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
+        with tracker.timer.stage('decode'):
+            ret, frame = vid.read()
+            if ret:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if not ret:
+            break
+        Ms = tracker.track(frame)
+        times.append(vid_time)
+        table.append([M if M is not None else np.nan * np.ones((3, 3))
+                      for M in Ms])
+        if verbose and tot and len(table) % 10 == 0:
+            sys.stdout.write('\r' + '%6.2f%%' % ((len(table) / tot) * 100))
+            sys.stdout.flush()
+    vid.release()
+    return (np.array(times),
+            np.array(table).reshape(-1, len(tracker.refs), 3, 3))
 
-    FLANN_INDEX_KDTREE = 0
-    num_matches = 2
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50)
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-    if len(kp1) >= num_matches and len(kp2) >= num_matches:
-        matches = flann.knnMatch(des1, des2, k=num_matches)
+
+def chunk_table(task):
+    """
+    Builds the homography table for one chunk of a video in a worker process,
+    returning it along with the worker's stage timings.
+    """
+    vid_path, match_paths, tracker_args, start, stop = task
+    timer = StageTimer()
+    tracker = ObjectTracker([cv2.cvtColor(cv2.imread(m), cv2.COLOR_BGR2GRAY)
+                             for m in match_paths], timer=timer,
+                            **tracker_args)
+    times, table = homography_table(vid_path, tracker, start, stop,
+                                    verbose=False)
+    return times, table, timer.totals
+
+
+def parallel_homography_table(vid_path, match_paths, jobs, timer=None,
+                              verbose=True, **tracker_args):
+    """
+    Like homography_table, but the video is split into chunks that `jobs`
+    worker processes each seek to, decode and track on their own.  The
+    chunks' results are merged back in order, and their stage timings are
+    added to `timer`.  Videos that don't report a frame count, or have
+    fewer frames than jobs, are tracked in a single pass instead.
+    """
+    vid = cv2.VideoCapture(vid_path)
+    if OPENCV3:
+        tot = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
     else:
-        return None
+        tot = int(vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
+    vid.release()
+    if tot < jobs:
+        tracker = ObjectTracker([cv2.cvtColor(cv2.imread(m),
+                                              cv2.COLOR_BGR2GRAY)
+                                 for m in match_paths], timer=timer,
+                                **tracker_args)
+        return homography_table(vid_path, tracker, verbose=verbose)
 
-    good = []
-    for m, n in matches:
-        if m.distance < 0.7*n.distance:
-            good.append(m)
+    # a few chunks per worker keeps them all busy to the end
+    bounds = sorted(set(np.linspace(0, tot, jobs * 4 + 1).astype(int)))
+    tasks = [(vid_path, match_paths, tracker_args, start, stop)
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+    # the frame count is only an estimate, so read the last chunk to the end
+    tasks[-1] = tasks[-1][:-1] + (None,)
 
-    if len(good) > MIN_MATCH_COUNT:
-        src_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
-        dst_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
+    pool = multiprocessing.Pool(jobs)
+    times = []
+    tables = []
+    for times_chunk, table_chunk, totals in pool.imap(chunk_table, tasks):
+        times.append(times_chunk)
+        tables.append(table_chunk)
+        if timer is not None:
+            for name, total in totals.items():
+                timer.totals[name] = timer.totals.get(name, 0.) + total
+        if verbose:
+            sys.stdout.write('\r' + '%6.2f%%' % (
+                (100. * len(tables)) / len(tasks)))
+            sys.stdout.flush()
+    pool.close()
+    pool.join()
+    return (np.concatenate(times),
+            np.concatenate(tables).reshape(-1, len(match_paths), 3, 3))
 
-        M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
 
-        return M
+def table_key(vid_path, match_paths, tracker_args):
+    """
+    Identifies a homography table by the video and match images it was
+    found from (fingerprinted with file_stamp, so the video isn't read in
+    full) and the tracker parameters used.
+    """
+    key = {'video': file_stamp(vid_path),
+           'matches': [file_stamp(m) for m in match_paths],
+           'tracker': sorted(tracker_args.items())}
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
 
-    else:
+
+def load_table(cache_path, key):
+    """
+    Returns the (times, table) saved at cache_path, or None if there is no
+    cache, it was made from a different video, match images or tracker
+    parameters, or it can't be read.
+    """
+    # a cache truncated by an interrupted save (before saves were atomic)
+    # isn't a whole zip file, and is simply recomputed
+    if not zipfile.is_zipfile(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            if str(cache['key']) != key:
+                return None
+            return cache['times'], cache['table']
+    except Exception:
         return None
 
 
-def track_objects(vid_path, gaze, matches, verbose=True):
+def save_table(cache_path, key, times, table):
+    # write then rename, so an interruption never leaves half a cache
+    tmp = cache_path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, key=key, times=times, table=table)
+    os.rename(tmp, cache_path)
+
+
+def project_points(pts, Ms):
+    """
+    Transforms each of the (n, 2) points by its own homography in the
+    (n, 3, 3) array Ms, all in one go.
+    """
+    pts = np.column_stack((pts, np.ones(len(pts))))
+    proj = np.einsum('nij,nj->ni', Ms, pts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return proj[:, :2] / proj[:, 2:]
+
+
+def track_objects(vid_path, gaze, matches, keyframe_interval=1,
+                  pyramid_level=0, roi_margin=None, jobs=1, recompute=False,
+                  writer='opencv', preset='veryfast', crf=23, data_only=False,
+                  verbose=True):
     """
     Tracks gaze over matches using sift feature matching in openCV.
     Saves a video of gaze plotted over each match as well as a .npy
-    file of gaze coordinates in each match image's coordinates
+    file of gaze coordinates in each match image's coordinates.  See
+    ObjectTracker for keyframe_interval, pyramid_level and roi_margin.
+
+    Homographies for every frame are found first, split over `jobs`
+    processes if jobs > 1, and gaze is then projected and drawn in a
+    sequential pass over them.  The homographies are saved next to the video
+    and reused on later runs with the same video, match images and tracker
+    parameters, unless recompute is set.
+
+    The opencv writer doubles the framerate and writes each frame twice,
+    once with each gaze sample drawn; other writers (see tobii_video) keep
+    the native framerate and draw each frame's gaze samples as a trail.
+    With data_only, no videos are written, only the .npy files.
     """
-    if verbose:
-        print "Tracking gaze over match images..."
-        sys.stdout.write('  0.00%')
+    match_paths = matches
 
-    gaze = pd.read_csv(gaze)
+    gaze = load_data(gaze, columns=GAZE_POS_COLUMNS)
     gaze = gaze[~gaze.vts_time.isnull()]  # only start tracking eyes once video starts
 
     matches = [{'path': m} for m in matches]
@@ -72,17 +460,13 @@ def track_objects(vid_path, gaze, matches, verbose=True):
     vid = cv2.VideoCapture(vid_path)
 
     if OPENCV3:
-        sift = cv2.xfeatures2d.SIFT_create()
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        tot = vid.get(cv2.CAP_PROP_FRAME_COUNT)*2.0
-        fps = vid.get(cv2.CAP_PROP_FPS)*2
+        fps = vid.get(cv2.CAP_PROP_FPS)
     else:
-        sift = cv2.SIFT()
-        fourcc = cv2.cv.CV_FOURCC(*'mp4v')
-        tot = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)*2.0
-        fps = vid.get(cv2.cv.CV_CAP_PROP_FPS)*2
-
-    ind = 1
+        fps = vid.get(cv2.cv.CV_CAP_PROP_FPS)
+    vid.release()
+    trail = writer != 'opencv'
+    if not trail:
+        fps *= 2
 
     # get gaze values
     gaze_val = gaze['gaze_pos_val'].values
@@ -93,76 +477,99 @@ def track_objects(vid_path, gaze, matches, verbose=True):
     # setup sift features and output for each match
     for i in range(len(matches)):
         matches[i]['name'] = os.path.basename(matches[i]['path']).split('.')[0]
-        outfile = vid_path.split('.mp4')[0] + '_match_%s.m4v' % matches[i]['name']
+        outfile = vid_path.split('.mp4')[0] + '_match_%s' % matches[i]['name']
         matches[i]['img'] = cv2.imread(matches[i]['path'])
-        matches[i]['sift'] = sift.detectAndCompute(cv2.cvtColor(
-                                                   matches[i]['img'],
-                                                   cv2.COLOR_BGR2GRAY), None)
         matches[i]['size'] = (matches[i]['img'].shape[1],
                               matches[i]['img'].shape[0])
-        matches[i]['video'] = cv2.VideoWriter()
-        matches[i]['video'].open(outfile, fourcc,
-                                 fps,
-                                 matches[i]['size'], True)
+        if not data_only:
+            matches[i]['video'] = open_writer(outfile, fps, matches[i]['size'],
+                                              writer, preset=preset, crf=crf)
+            matches[i]['renderer'] = TraceRenderer(matches[i]['img'])
         # x, y pairs of gaze locations over object. Init as -1
         matches[i]['obj_gaze'] = np.ones((len(gaze_x), 2)) * -1
 
-    while vid.isOpened():
-        if OPENCV3:
-            vid_time = vid.get(cv2.CAP_PROP_POS_MSEC)
-        else:
-            vid_time = vid.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-        ret, frame = vid.read()
-        if ret:
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            for i in range(len(matches)):
-                matches[i]['M'] = object_find(matches[i]['sift'], frame, 50)
-            # 2 frames per original frame
-            for j in range(2):
-                # make sure eye tracking data exists for current frame
-                if ind < len(vts):
-                    # make sure eye tracking data is not ahead of video
-                    if vts[ind] <= vid_time:
-                        for match in matches:  # draw on every match image
-                            img_cp = match['img'].copy()
-                            if gaze_val[ind] == 0:  # if gaze point is valid
-                                if match['M'] is not None:
-                                    org_pos = np.array((1920*gaze_x[ind], 1080*gaze_y[ind])).reshape(-1, 1, 2)
-                                    trans_pos = cv2.perspectiveTransform(org_pos, match['M'])
-                                    trans_pos = tuple(np.int32(trans_pos[0, 0]))
-                                    if (trans_pos[0] <= match['size'][0] and trans_pos[0] >= 0 and
-                                            trans_pos[1] <= match['size'][1] and trans_pos[1] >= 0):
-                                        cv2.circle(img_cp, trans_pos, 8, [255, 0, 0], -2)  # draw blue circle on current frame
-                                        cv2.circle(match['img'], trans_pos, 8, [0, 255, 0], 2)  # draw green circle as trace
-                                        match['obj_gaze'][ind, :] = trans_pos
-                            match['video'].write(img_cp)
-                        ind += 1
-                    else:
-                        for match in matches:
-                            match['video'].write(match['img'])
-                else:
-                    for match in matches:
-                        match['video'].write(match['img'])
-                if ind % 10 == 0 and verbose:
-                    sys.stdout.write('\r' + '%6.2f%%' % ((ind/tot)*100))
-                    sys.stdout.flush()
+    timer = StageTimer()
+    tracker_args = dict(min_match_count=50,
+                        keyframe_interval=keyframe_interval,
+                        pyramid_level=pyramid_level,
+                        roi_margin=roi_margin)
+    cache_path = vid_path.split('.mp4')[0] + '_homographies.npz'
+    key = table_key(vid_path, match_paths, tracker_args)
+    cached = None if recompute else load_table(cache_path, key)
+    if cached is not None:
+        if verbose:
+            print "Using match images found in %s" % cache_path
+        times, table = cached
+    else:
+        if verbose:
+            print "Finding match images in video..."
+            sys.stdout.write('  0.00%')
+        if jobs > 1:
+            times, table = parallel_homography_table(
+                vid_path, match_paths, jobs, timer=timer, verbose=verbose,
+                **tracker_args)
         else:
-            break
-        # catch up gaze data in case it's behind
-        try:
-            while vts[ind + 1] < vid_time:
-                ind += 1
-        except IndexError:  # in case vts reaches end
-            pass
+            tracker = ObjectTracker([cv2.cvtColor(match['img'],
+                                                  cv2.COLOR_BGR2GRAY)
+                                     for match in matches], timer=timer,
+                                    **tracker_args)
+            times, table = homography_table(vid_path, tracker,
+                                            verbose=verbose)
+        save_table(cache_path, key, times, table)
+        if verbose:
+            print
+    frames = len(times)
+
+    if verbose:
+        print "Tracking gaze over match images..."
+        sys.stdout.write('  0.00%')
+    # 2 samples per original frame to match the doubled framerate, or all of
+    # them for a trail
+    bounds = align_frames(vts, times)
+    shown = frame_samples(bounds, np.diff(bounds).max() if trail and frames
+                          else 2)
+
+    with timer.stage('project'):
+        # every valid gaze sample that gets shown, and the frame it's shown on
+        frame_of, slot = np.nonzero(shown >= 0)
+        samples = shown[frame_of, slot]
+        valid = gaze_val[samples] == 0
+        samples, frame_of = samples[valid], frame_of[valid]
+        pos = np.column_stack((1920 * gaze_x[samples], 1080 * gaze_y[samples]))
+        for i, match in enumerate(matches):
+            Ms = table[frame_of, i]
+            found = ~np.isnan(Ms[:, 0, 0])
+            trans_pos = np.int32(project_points(pos[found], Ms[found]))
+            inside = ((trans_pos[:, 0] >= 0) &
+                      (trans_pos[:, 0] <= match['size'][0]) &
+                      (trans_pos[:, 1] >= 0) &
+                      (trans_pos[:, 1] <= match['size'][1]))
+            match['obj_gaze'][samples[found][inside]] = trans_pos[inside]
+
+    for f in range(0 if data_only else frames):
+        with timer.stage('draw'):
+            # 2 frames per original frame, or 1 with a trail
+            groups = [shown[f]] if trail else [[ind] for ind in shown[f]]
+            for group in groups:
+                for match in matches:  # draw on every match image
+                    # samples where gaze is on the match image
+                    on_obj = [ind for ind in group
+                              if ind >= 0 and match['obj_gaze'][ind, 0] >= 0]
+                    match['video'].write(
+                        match['renderer'].frame(match['obj_gaze'][on_obj]))
+        if (f + 1) % 10 == 0 and verbose:
+            sys.stdout.write('\r' + '%6.2f%%' % ((100. * (f + 1)) / frames))
+            sys.stdout.flush()
 
-    vid.release()
     for i in range(len(matches)):
         obj_gaze_path = vid_path.split('.mp4')[0] + '_match_%s.npy' % matches[i]['name']
-        matches[i]['video'].release()  # save video
+        if not data_only:
+            matches[i]['video'].release()  # save video
         np.save(obj_gaze_path, matches[i]['obj_gaze'])  # save gaze points
 
     if verbose:
         print
+        timer.report(frames)
         print "Done!"
 
 
@@ -171,10 +578,51 @@ if __name__ == '__main__':
     parser.add_argument(
         'video', help='Tobii scene camera video')
     parser.add_argument(
-        'data', help='Tobii gaze data (converted to csv by tobii_data_process')
+        'data', help='Tobii gaze data (converted by tobii_data_process')
     parser.add_argument(
         '-m', '--match', nargs='+',
         help='REQUIRED: Image(s) to find in the video', required=True)
+    parser.add_argument(
+        '-k', '--keyframe-interval', type=int, default=1,
+        help='Run full feature matching every this many frames, following ' +
+             'the match images with optical flow in between. Default is 1 ' +
+             '(match every frame).')
+    parser.add_argument(
+        '-p', '--pyramid-level', type=int, default=0,
+        help='Detect frame features at this pyramid level, each level ' +
+             'halving the resolution. Default is 0 (full resolution).')
+    parser.add_argument(
+        '-r', '--roi-margin', type=float, default=None,
+        help='Only search the region around where the match images were ' +
+             'last found, padded by this fraction of its size. Default is ' +
+             'to search the whole frame.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of processes to split the video between when finding ' +
+             'match images.')
+    parser.add_argument(
+        '-w', '--writer', choices=sorted(WRITERS), default='opencv',
+        help='Video writer backend.  ffmpeg encodes H.264 at the native ' +
+             'framerate, with gaze drawn as a trail.  Default is opencv.')
+    parser.add_argument(
+        '--preset', default='veryfast',
+        help='x264 preset for the ffmpeg writer')
+    parser.add_argument(
+        '--crf', type=int, default=23,
+        help='x264 constant rate factor for the ffmpeg writer')
+    parser.add_argument(
+        '--data-only', action='store_true',
+        help='Only save gaze in match image coordinates (.npy), without ' +
+             'writing videos.')
+    parser.add_argument(
+        '--recompute', action='store_true',
+        help='Find the match images again even if the video has saved ' +
+             'homographies from an earlier run.')
     args = parser.parse_args()
 
-    track_objects(args.video, args.data, args.match)
+    track_objects(args.video, args.data, args.match,
+                  keyframe_interval=args.keyframe_interval,
+                  pyramid_level=args.pyramid_level,
+                  roi_margin=args.roi_margin, jobs=args.jobs,
+                  recompute=args.recompute, writer=args.writer,
+                  preset=args.preset, crf=args.crf, data_only=args.data_only)
@@ -0,0 +1,273 @@
+'''
+    Video writer backends for the gaze overlay scripts.  The opencv backend
+    writes mp4v through cv2.VideoWriter; the ffmpeg backend streams raw
+    frames to an ffmpeg process over a pipe and encodes them as H.264.  Also
+    a low latency ffmpeg decoder for live video streams.
+'''
+from collections import deque
+import cv2
+import numpy as np
+import Queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+OPENCV3 = (cv2.__version__.split('.')[0] == '3')
+
+WRITERS = {'opencv': '.m4v', 'ffmpeg': '.mp4'}
+
+
+class FFmpegWriter(object):
+    """
+    Writes BGR frames of the given size to an H.264 video by piping them to
+    ffmpeg.  `preset` and `crf` are passed to libx264 and trade encoding
+    speed and quality against file size.  yuv420p needs even dimensions, so
+    odd sized frames get a black row or column added at the bottom or right.
+    """
+    def __init__(self, path, fps, size, preset='veryfast', crf=23,
+                 ffmpeg='ffmpeg'):
+        self.size = tuple(size)
+        cmd = [ffmpeg, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+               '-s', '%dx%d' % self.size, '-r', repr(float(fps)), '-i', '-',
+               '-an', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+               '-c:v', 'libx264', '-preset', preset,
+               '-crf', str(crf), '-pix_fmt', 'yuv420p', path]
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        except OSError:
+            raise Exception('Unable to run %s, is ffmpeg installed?' % ffmpeg)
+
+    def write(self, frame):
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size)
+        self.proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise Exception('ffmpeg exited with code %i' %
+                            self.proc.returncode)
+
+
+def ts_video_pts(data):
+    """
+    Returns the PTS of each video PES packet starting in `data`, a run of
+    whole 188 byte MPEG-TS packets such as a live video datagram.
+    """
+    data = bytearray(data)
+    stamps = []
+    for pos in range(0, len(data) - 187, 188):
+        # sync byte, and payload unit start for the start of a PES packet
+        if data[pos] != 0x47 or not data[pos + 1] & 0x40:
+            continue
+        control = data[pos + 3] >> 4 & 3
+        pes = pos + 4
+        if control & 2:
+            pes += 1 + data[pos + 4]  # skip the adaptation field
+        if not control & 1 or pes + 14 > pos + 188:
+            continue
+        # video stream ids are 0xe0-0xef, and the header must carry a PTS
+        if (data[pes:pes + 3] != '\x00\x00\x01' or
+                data[pes + 3] & 0xf0 != 0xe0 or not data[pes + 7] & 0x80):
+            continue
+        t = data[pes + 9:pes + 14]
+        stamps.append((t[0] >> 1 & 7) << 30 | t[1] << 22 | (t[2] >> 1) << 15 |
+                      t[3] << 7 | t[4] >> 1)
+    return stamps
+
+
+class FFmpegDecoder(object):
+    """
+    Decodes a video stream (MPEG-TS by default) that is fed in as bytes,
+    using an ffmpeg process with its low latency options, so that each frame
+    comes out as soon as it can be decoded.  Frames are BGR arrays scaled to
+    the given size.
+
+    With timestamps, ffmpeg also logs each frame's PTS as it is decoded, and
+    after each read `pts` is that of the frame read (or None if it wasn't
+    logged), in the stream's own time base as ts_video_pts gives it.
+
+    Joining a stream mid-way, the decoder reports an error for every packet
+    until a keyframe comes by, so decoding errors are held back until the
+    first frame has been read (the last few are shown if ffmpeg ends before
+    then), and then passed on to stderr at most once every `error_interval`
+    seconds, with a count of those held back.  Fatal errors are always
+    passed on.
+    """
+    def __init__(self, size, input_format='mpegts', ffmpeg='ffmpeg',
+                 timestamps=False, error_interval=5.):
+        self.size = tuple(size)
+        self.frame_bytes = self.size[0] * self.size[1] * 3
+        self.error_interval = error_interval
+        self.pts = None
+        self.decoding = False
+        # joining a stream mid-way, its format is only known once a keyframe
+        # comes by, so the probe may read a few MB waiting for one, but ends
+        # as soon as it has (an analyzeduration of 0 would mean the 5 s
+        # default, and fpsprobesize 0 skips waiting on frames to measure the
+        # frame rate).  Probed packets are kept (no nobuffer flag), so
+        # decoding starts from that keyframe rather than the one after.
+        cmd = [ffmpeg, '-hide_banner', '-nostats', '-loglevel', 'level+error',
+               '-flags', 'low_delay',
+               '-probesize', '5000000', '-analyzeduration', '1',
+               '-fpsprobesize', '0',
+               '-f', input_format, '-i', '-',
+               '-an', '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+               '-s', '%dx%d' % self.size, '-']
+        if timestamps:
+            # showinfo logs at info level, and tagging each line with its
+            # level tells errors apart.  copyts keeps the stream's own PTS.
+            cmd[4] = 'level+info'
+            cmd[-1:] = ['-copyts', '-vf', 'showinfo', '-']
+        try:
+            self.proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, bufsize=0)
+        except OSError:
+            raise Exception('Unable to run %s, is ffmpeg installed?' % ffmpeg)
+        self.stamps = Queue.Queue() if timestamps else None
+        self.log_thread = threading.Thread(target=self._read_log)
+        self.log_thread.daemon = True
+        self.log_thread.start()
+
+    def _read_log(self):
+        shown = re.compile(r'\bn:\s*\d+\s+pts:\s*(-?\d+)')
+        early = deque(maxlen=5)
+        last_error = None
+        held = 0
+        for line in iter(self.proc.stderr.readline, ''):
+            match = shown.search(line)
+            if match is not None:
+                if self.stamps is not None:
+                    self.stamps.put(int(match.group(1)))
+            elif '[fatal]' in line:
+                sys.stderr.write(line)
+            elif '[error]' in line and not self.decoding:
+                early.append(line)
+            elif '[error]' in line:
+                now = time.time()
+                if last_error is not None and \
+                        now - last_error < self.error_interval:
+                    held += 1
+                    continue
+                if held:
+                    line = line.rstrip('\n') + ' (and %i more errors)\n' % held
+                sys.stderr.write(line)
+                last_error = now
+                held = 0
+        if not self.decoding:
+            sys.stderr.writelines(early)
+        elif held:
+            sys.stderr.write('(and %i more ffmpeg errors)\n' % held)
+
+    def feed(self, data):
+        self.proc.stdin.write(data)
+
+    def read(self):
+        """
+        Returns the next decoded frame, or None once the stream has ended.
+        """
+        buf = bytearray(self.frame_bytes)
+        view = memoryview(buf)
+        got = 0
+        while got < self.frame_bytes:
+            n = self.proc.stdout.readinto(view[got:])
+            if not n:
+                return None
+            got += n
+        self.decoding = True
+        if self.stamps is not None:
+            # logged before the frame was written out, so it's (about) here
+            try:
+                self.pts = self.stamps.get(timeout=1)
+            except Queue.Empty:
+                self.pts = None
+        return np.frombuffer(buf, np.uint8).reshape(
+            self.size[1], self.size[0], 3)
+
+    def close(self):
+        """
+        Stops decoding.  Frames not yet read are dropped: ffmpeg is killed
+        if it's still running, as even when asked to quit it waits for them
+        to be read.
+        """
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+
+def open_writer(path, fps, size, writer='opencv', preset='veryfast',
+                crf=23):
+    """
+    Opens a video for writing with one of the WRITERS backends.  `path` is
+    without an extension, which is added to suit the backend.
+    """
+    path += WRITERS[writer]
+    if writer == 'ffmpeg':
+        return FFmpegWriter(path, fps, size, preset=preset, crf=crf)
+    if OPENCV3:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    else:
+        fourcc = cv2.cv.CV_FOURCC(*'mp4v')
+    out = cv2.VideoWriter()
+    out.open(path, fourcc, fps, size, True)
+    return out
+
+
+def draw_trail(img, pts, color=(255, 0, 0)):
+    """
+    Draws gaze points (in time order) as a trail: a line through them with a
+    small dot at each earlier point and a full size one at the latest.
+    """
+    pts = [tuple(int(c) for c in pt) for pt in pts]
+    for pt, next_pt in zip(pts[:-1], pts[1:]):
+        cv2.line(img, pt, next_pt, color, 2)
+        cv2.circle(img, pt, 4, color, -2)
+    if pts:
+        cv2.circle(img, pts[-1], 8, color, -2)
+
+
+class TraceRenderer(object):
+    """
+    Draws gaze over a still image, leaving a trace of everywhere it has been.
+    The trace is kept as its own persistent layer, and each frame is drawn
+    on a single canvas by restoring just the small rectangle around the
+    previous frame's gaze from the trace, rather than copying the whole
+    image every frame.
+    """
+    def __init__(self, img, color=(255, 0, 0), trace_color=(0, 255, 0)):
+        self.trace = img.copy()
+        self.canvas = img.copy()
+        self.color = color
+        self.trace_color = trace_color
+        self.dirty = None
+
+    def frame(self, pts):
+        """
+        Returns the image for a frame with gaze at `pts` (in time order, may
+        be empty), then adds those points to the trace.  The image is reused
+        by the next call, so write it out before then.
+        """
+        if self.dirty is not None:
+            x0, y0, x1, y1 = self.dirty
+            self.canvas[y0:y1, x0:x1] = self.trace[y0:y1, x0:x1]
+            self.dirty = None
+        if len(pts) == 0:
+            return self.canvas
+        pts = np.int32(pts)
+        draw_trail(self.canvas, pts, self.color)
+        for pt in pts:
+            cv2.circle(self.trace, tuple(pt), 8, self.trace_color, 2)
+        # covers the dot and the trace circle around each point
+        pad = 8 + 2 + 1
+        x0, y0 = np.maximum(pts.min(0) - pad, 0)
+        x1, y1 = pts.max(0) + pad + 1
+        self.dirty = (x0, y0, x1, y1)
+        return self.canvas
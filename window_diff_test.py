@@ -0,0 +1,79 @@
+'''
+Run this script to check that tobii_data_process.window_diff still matches
+the original per-sample implementation, kept here as the reference.  It
+covers NaN gaps, the truncated window at the start of the series and the
+shrinking window at its end.
+'''
+import warnings
+import numpy as np
+import pandas as pd
+from tobii_data_process import window_diff
+
+
+def reference_window_diff(data, width):
+    """
+    The original window_diff: np.nanmean of the windows either side of each
+    sample, one sample at a time.
+    """
+    diff = data.copy()
+    for i in range(len(data)):
+        if i < width:
+            win_m = (np.nanmean(data[:i]) + np.nanmean(data[i+1:i+1+width]))/2
+        else:
+            win_m = (np.nanmean(data[i-width:i]) + np.nanmean(data[i+1:i+1+width]))/2
+        diff[i] -= win_m
+    return diff
+
+
+def check(data, width):
+    with warnings.catch_warnings():
+        # nanmean warns about empty and all-NaN windows
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.asarray(reference_window_diff(data, width))
+    got = np.asarray(window_diff(data, width))
+    if not np.array_equal(np.isnan(got), np.isnan(expected)):
+        raise Exception('window_diff NaNs differ from the reference '
+                        '(width %i, %i samples)' % (width, len(data)))
+    both = ~np.isnan(got)
+    if not np.allclose(got[both], expected[both], rtol=1e-9, atol=1e-9):
+        raise Exception('window_diff differs from the reference by up to %g '
+                        '(width %i, %i samples)' % (
+                            np.abs(got[both] - expected[both]).max(), width,
+                            len(data)))
+
+
+def test_clean_series():
+    rng = np.random.RandomState(0)
+    data = pd.Series(3 + rng.randn(500) * 0.2, name='l_pup_diam')
+    for width in (1, 5, 10):
+        check(data, width)
+
+
+def test_nan_gaps():
+    rng = np.random.RandomState(1)
+    values = 3 + rng.randn(300) * 0.2
+    values[rng.rand(300) < 0.2] = np.nan  # scattered dropouts
+    values[100:130] = np.nan  # a gap wider than the window
+    values[:3] = np.nan  # the first window has nothing to its left
+    check(pd.Series(values, name='r_pup_diam'), 10)
+
+
+def test_window_edges():
+    rng = np.random.RandomState(2)
+    # shorter than the window, so every sample's window is truncated on the
+    # left and shrinks on the right
+    for n in (1, 2, 7, 10, 11, 21):
+        check(pd.Series(rng.rand(n), name='l_pup_diam'), 10)
+    values = rng.rand(25)
+    values[-2:] = np.nan  # the last windows to the right are all NaN
+    check(pd.Series(values, name='l_pup_diam'), 10)
+
+
+def main():
+    test_clean_series()
+    test_nan_gaps()
+    test_window_edges()
+    print 'window_diff matches the reference'
+
+if __name__ == '__main__':
+    main()